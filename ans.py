@@ -0,0 +1,314 @@
+import struct
+from utils import BitWriter, BitReader
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# asymmetric numeral systems over the same get_cum_count tables as artihmetic.py.
+# both coders need the total to be a power of two, so counts are rescaled to 1 << scale_bits first,
+# every symbol present in cum_count keeps a count of at least 1
+def normalize_cum_count(cum_count, scale_bits):
+    total = cum_count[-1]
+    M = 1 << scale_bits
+    counts = [cum_count[s + 1] - cum_count[s] for s in range(len(cum_count) - 1)]
+    if total == M:
+        return list(cum_count)
+
+    present = sum(1 for c in counts if c > 0)
+    if present == 0 or present > M:
+        raise ValueError('{} symbols do not fit a total of {}'.format(present, M))
+
+    freq = [max(1, c * M // total) if c > 0 else 0 for c in counts]
+    order = sorted(range(len(counts)), key = lambda s: counts[s], reverse = True)
+    diff = M - sum(freq)
+    if diff > 0:
+        freq[order[0]] += diff
+    # symbols forced up to 1 are paid for by the most frequent ones
+    for s in order:
+        if diff >= 0:
+            break
+        take = min(freq[s] - 1, -diff)
+        freq[s] -= take
+        diff += take
+
+    result = [0]
+    for f in freq:
+        result.append(result[-1] + f)
+    return result
+
+def symbol_frequencies(C):
+    return [C[s + 1] - C[s] for s in range(len(C) - 1)]
+
+# rANS with 32-bit states and 16-bit renormalisation: a state stays in [RANS_L, 1 << 32) and
+# emits at most one word per symbol. Symbol i goes through state i % n_states, all states share
+# one word stream. The encoder runs backwards, the stream is stored in the order the decoder
+# reads it: the n_states initial states (2 words each) followed by the renormalisation words
+RANS_L = 1 << 16
+
+# the 16-bit renormalisation only round trips while the total 1 << scale_bits divides RANS_L
+def check_scale_bits(scale_bits):
+    if not 1 <= scale_bits <= 16:
+        raise ValueError('scale_bits {} is outside 1..16'.format(scale_bits))
+
+def encode_rans(cum_count, sequence, n_states = 4, scale_bits = 16):
+    check_scale_bits(scale_bits)
+    C = normalize_cum_count(cum_count, scale_bits)
+    freq = symbol_frequencies(C)
+    shift = 32 - scale_bits
+
+    states = [RANS_L] * n_states
+    words = []
+    for i in range(len(sequence) - 1, -1, -1):
+        s = sequence[i]
+        f = freq[s]
+        k = i % n_states
+        x = states[k]
+        if x >= f << shift:
+            words.append(x & 0xffff)
+            x >>= 16
+        states[k] = ((x // f) << scale_bits) + x % f + C[s]
+
+    for x in reversed(states):
+        words.append(x & 0xffff)
+        words.append(x >> 16)
+    words.reverse()
+    return bytearray(struct.pack('>{}H'.format(len(words)), *words))
+
+def decode_rans(cum_count, data, dec_len, n_states = 4, scale_bits = 16):
+    check_scale_bits(scale_bits)
+    C = normalize_cum_count(cum_count, scale_bits)
+    freq = symbol_frequencies(C)
+    mask = (1 << scale_bits) - 1
+
+    symbol_of_slot = []
+    for s in range(len(freq)):
+        symbol_of_slot.extend([s] * freq[s])
+
+    words = struct.unpack('>{}H'.format(len(data) // 2), data)
+    states = [(words[2 * k] << 16) | words[2 * k + 1] for k in range(n_states)]
+    p = 2 * n_states
+
+    result = []
+    for i in range(dec_len):
+        k = i % n_states
+        x = states[k]
+        slot = x & mask
+        s = symbol_of_slot[slot]
+        x = freq[s] * (x >> scale_bits) + slot - C[s]
+        if x < RANS_L:
+            x = (x << 16) | words[p]
+            p += 1
+        states[k] = x
+        result.append(s)
+    return result
+
+# numpy versions of the above, one step moves all n_states states at once and the
+# output is identical to encode_rans / decode_rans with the same n_states
+def encode_rans_array(cum_count, array, n_states = 256, scale_bits = 16):
+    check_scale_bits(scale_bits)
+    C = normalize_cum_count(cum_count, scale_bits)
+    freq = np.array(symbol_frequencies(C), dtype = np.uint64)
+    cum = np.array(C, dtype = np.uint64)
+    symbols = np.asarray(array, dtype = np.int64)
+    n = len(symbols)
+    shift = 32 - scale_bits
+
+    x = np.full(n_states, RANS_L, dtype = np.uint64)
+    chunks = []
+    for start in range(((n - 1) // n_states) * n_states, -1, -n_states):
+        s = symbols[start:start + n_states]
+        w = len(s)
+        xs = x[:w]
+        f = freq[s]
+        renorm = xs >= (f << shift)
+        # the scalar encoder visits the row from the last state down
+        chunks.append((xs[renorm] & 0xffff)[::-1])
+        xs = np.where(renorm, xs >> 16, xs)
+        x[:w] = ((xs // f) << scale_bits) + xs % f + cum[s]
+
+    chunks.append(np.stack([x & 0xffff, x >> 16], axis = 1)[::-1].ravel())
+    words = np.concatenate(chunks)[::-1]
+    return bytearray(words.astype('>u2').tobytes())
+
+def decode_rans_array(cum_count, data, dec_len, n_states = 256, scale_bits = 16):
+    check_scale_bits(scale_bits)
+    C = normalize_cum_count(cum_count, scale_bits)
+    freq = np.array(symbol_frequencies(C), dtype = np.uint64)
+    cum = np.array(C, dtype = np.uint64)
+    symbol_of_slot = np.repeat(np.arange(len(freq)), freq.astype(np.int64))
+    mask = (1 << scale_bits) - 1
+
+    words = np.frombuffer(bytes(data), dtype = '>u2').astype(np.uint64)
+    x = (words[0:2 * n_states:2] << 16) | words[1:2 * n_states:2]
+    p = 2 * n_states
+
+    result = np.empty(dec_len, dtype = np.int64)
+    for start in range(0, dec_len, n_states):
+        w = min(n_states, dec_len - start)
+        xs = x[:w]
+        slot = xs & mask
+        s = symbol_of_slot[slot]
+        xs = freq[s] * (xs >> scale_bits) + slot - cum[s]
+        renorm = xs < RANS_L
+        count = int(np.count_nonzero(renorm))
+        xs[renorm] = (xs[renorm] << 16) | words[p:p + count]
+        p += count
+        x[:w] = xs
+        result[start:start + w] = s
+    return result
+
+# table driven tANS (fse style): 1 << table_log states, symbols spread over the table with an odd step,
+# a state transition is one table lookup plus a variable number of raw bits
+def build_tans_tables(cum_count, table_log = 12):
+    C = normalize_cum_count(cum_count, table_log)
+    freq = symbol_frequencies(C)
+    L = 1 << table_log
+
+    spread = [0] * L
+    step = (L >> 1) + (L >> 3) + 3
+    pos = 0
+    for s in range(len(freq)):
+        for _ in range(freq[s]):
+            spread[pos] = s
+            pos = (pos + step) & (L - 1)
+
+    # decode entries are (symbol, bits to read, base of the next state),
+    # encode maps the (symbol, reduced state) pair back to the table position
+    decode_table = [None] * L
+    encode_table = [0] * L
+    next_state = list(freq)
+    for u in range(L):
+        s = spread[u]
+        x = next_state[s]
+        next_state[s] += 1
+        n_bits = table_log - (x.bit_length() - 1)
+        decode_table[u] = (s, n_bits, (x << n_bits) - L)
+        encode_table[C[s] + x - freq[s]] = L + u
+
+    # states at or above threshold drop k bits, the others k - 1
+    symbol_bits = []
+    for s in range(len(freq)):
+        k = table_log - (freq[s].bit_length() - 1)
+        symbol_bits.append((k, freq[s] << k, C[s] - freq[s]))
+
+    return (table_log, decode_table, encode_table, symbol_bits)
+
+def encode_tans(tables, sequence, n_states = 4):
+    (table_log, decode_table, encode_table, symbol_bits) = tables
+    L = 1 << table_log
+
+    states = [L] * n_states
+    emitted = []
+    for i in range(len(sequence) - 1, -1, -1):
+        (k, threshold, offset) = symbol_bits[sequence[i]]
+        x = states[i % n_states]
+        if x < threshold:
+            k -= 1
+        emitted.append((x & ((1 << k) - 1), k))
+        states[i % n_states] = encode_table[offset + (x >> k)]
+
+    writer = BitWriter()
+    for x in states:
+        writer.write(x - L, table_log)
+    for (value, n_bits) in reversed(emitted):
+        writer.write(value, n_bits)
+    return writer.flush()
+
+def decode_tans(tables, data, dec_len, n_states = 4):
+    (table_log, decode_table, encode_table, symbol_bits) = tables
+
+    reader = BitReader(data)
+    states = [reader.read(table_log) for _ in range(n_states)]
+    result = []
+    for i in range(dec_len):
+        k = i % n_states
+        (s, n_bits, base) = decode_table[states[k]]
+        states[k] = base + reader.read(n_bits)
+        result.append(s)
+    return result
+
+import unittest
+import random
+import math
+from artihmetic import get_cum_count, encode_range, RoundTripCases
+
+class AnsTestCase(RoundTripCases, unittest.TestCase):
+    def _test_series(self, counts, series):
+        C = get_cum_count(counts)
+        tables = build_tans_tables(C)
+
+        for s in series:
+            for n_states in [1, 4]:
+                enc = encode_rans(C, s, n_states)
+                self.assertEqual(decode_rans(C, enc, len(s), n_states), s)
+
+                enc = encode_tans(tables, s, n_states)
+                self.assertEqual(decode_tans(tables, enc, len(s), n_states), s)
+
+            if np is not None:
+                enc = encode_rans_array(C, s, 8)
+                self.assertEqual(enc, encode_rans(C, s, 8))
+                self.assertEqual(decode_rans_array(C, enc, len(s), 8).tolist(), s)
+
+    def test_normalize(self):
+        self.assertEqual(normalize_cum_count([0, 1, 4], 2), [0, 1, 4])
+        self.assertEqual(normalize_cum_count([0, 1, 3], 2), [0, 1, 4])
+        self.assertEqual(normalize_cum_count([0, 1, 3], 4), [0, 5, 16])
+        self.assertEqual(normalize_cum_count([0, 1, 1, 100001], 4), [0, 1, 1, 16])
+
+        C = normalize_cum_count(get_cum_count([1000] + [1] * 100), 8)
+        self.assertEqual(C[-1], 256)
+        self.assertTrue(all(C[s + 1] > C[s] for s in range(101)))
+
+        with self.assertRaises(ValueError):
+            normalize_cum_count(get_cum_count([1] * 17), 4)
+
+    def test_scale_bits(self):
+        random.seed(4)
+        C = [0, 1, 3, 1000]
+        s = [random.choice([0, 1, 1, 2, 2, 2]) for _ in range(20000)]
+        for scale_bits in [10, 16]:
+            enc = encode_rans(C, s, scale_bits = scale_bits)
+            self.assertEqual(decode_rans(C, enc, len(s), scale_bits = scale_bits), s)
+
+        functions = [encode_rans, decode_rans]
+        if np is not None:
+            functions += [encode_rans_array, decode_rans_array]
+        for scale_bits in [0, 17, 24]:
+            for f in functions:
+                args = (C, s) if f in (encode_rans, encode_rans_array) else (C, bytes(2048), len(s))
+                self.assertRaises(ValueError, f, *args, scale_bits = scale_bits)
+
+    def test_size(self):
+        random.seed(0)
+        counts = [1] * 16
+        s = []
+        for _ in range(20000):
+            x = math.floor(random.betavariate(5, 1) * 16)
+            counts[x] += 1
+            s.append(x)
+
+        C = get_cum_count(counts)
+        reference = len(encode_range(C, s))
+        self.assertLess(len(encode_rans(C, s)), reference * 1.01 + 16)
+        self.assertLess(len(encode_tans(build_tans_tables(C), s)), reference * 1.01 + 16)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_array(self):
+        random.seed(1)
+        counts = [random.randint(0, 50) for _ in range(300)]
+        counts[0] += 1
+        C = get_cum_count(counts)
+        s = [x for x in range(len(counts)) for _ in range(counts[x])]
+        random.shuffle(s)
+
+        for n_states in [1, 7, 256, 4096]:
+            enc = encode_rans_array(C, s, n_states)
+            self.assertEqual(enc, encode_rans(C, s, n_states))
+            self.assertEqual(decode_rans_array(C, enc, len(s), n_states).tolist(), s)
+            self.assertEqual(decode_rans(C, enc, len(s), n_states), s)
+
+        enc = encode_rans_array(C, np.array(s, dtype = np.uint16), 64)
+        self.assertEqual(decode_rans_array(C, enc, len(s), 64).tolist(), s)
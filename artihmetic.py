@@ -1,6 +1,8 @@
+import bisect
 import itertools
 import functools
 import math
+from utils import map_chunks, pack_frame, unpack_frame
 
 def get_cum_count(counts):
     return [0] + list(itertools.accumulate(counts))
@@ -8,6 +10,19 @@ def get_cum_count(counts):
 def get_min_word_len(counts):
     return (get_cum_count(counts)[-1] * 4).bit_length()
 
+# maps a cumulative count to the symbol whose interval contains it, so decoding does not scan the alphabet:
+# a direct table when the total is small, a bisect over cum_count otherwise (zero counts are skipped by bisect_right)
+DIRECT_LOOKUP_LIMIT = 1 << 16
+
+def build_symbol_lookup(cum_count, limit = DIRECT_LOOKUP_LIMIT):
+    if cum_count[-1] <= limit:
+        table = []
+        for symbol in range(len(cum_count) - 1):
+            table.extend([symbol] * (cum_count[symbol + 1] - cum_count[symbol]))
+        return table.__getitem__
+
+    return lambda C: bisect.bisect_right(cum_count, C) - 1
+
 def encode(cum_count, m, sequence):
     result = []
 
@@ -67,8 +82,10 @@ def encode(cum_count, m, sequence):
 
     return result
 
-def decode(cum_count, m, sequence, dec_len):
+def decode(cum_count, m, sequence, dec_len, lookup = None):
     result = []
+    if lookup is None:
+        lookup = build_symbol_lookup(cum_count)
 
     l = 0
     u = (1 << m) - 1
@@ -86,11 +103,8 @@ def decode(cum_count, m, sequence, dec_len):
     sequence_index = m
 
     def decode_symbol():
-        symbol = 0
-        C = math.floor(((t - l + 1) * total_count - 1) / (u - l + 1))
-        while C >= cum_count[symbol + 1]:
-            symbol = symbol + 1
-        return symbol
+        C = ((t - l + 1) * total_count - 1) // (u - l + 1)
+        return lookup(C)
 
     symbol = decode_symbol()
     result.append(symbol)
@@ -137,32 +151,231 @@ def decode(cum_count, m, sequence, dec_len):
 
     return result
 
-import unittest
-import random
+# byte-oriented range coder: 32 bit range, renormalised 8 bits at a time, carries are propagated through
+# a cached byte and a run of pending 0xff bytes (same scheme as lzma), so everything stays in integers
+# range_max has to fit below RANGE_BOTTOM and [range_l, range_u) must not be empty, otherwise range
+# collapses to 0 and renormalisation never ends, encode and decode raise ValueError instead
+RANGE_TOP = 1 << 32
+RANGE_BOTTOM = 1 << 24
+
+class RangeEncoder:
+    def __init__(self):
+        self.low = 0
+        self.range = RANGE_TOP - 1
+        self.cache = 0
+        self.cache_size = 1
+        self.result = bytearray()
+
+    def shift_low(self):
+        low = self.low
+        if low < 0xff000000 or low >= RANGE_TOP:
+            carry = low >> 32
+            self.result.append((self.cache + carry) & 0xff)
+            if self.cache_size > 1:
+                self.result.extend(bytes([(0xff + carry) & 0xff]) * (self.cache_size - 1))
+            self.cache_size = 0
+            self.cache = (low >> 24) & 0xff
+        self.cache_size += 1
+        self.low = (low & 0x00ffffff) << 8
+
+    def encode(self, range_l, range_u, range_max):
+        if not 0 <= range_l < range_u <= range_max <= RANGE_BOTTOM:
+            raise ValueError('interval [{}, {}) of {} is empty or does not fit the range coder'.format(range_l, range_u, range_max))
+        r = self.range // range_max
+        self.low += r * range_l
+        self.range = r * (range_u - range_l)
+        while self.range < RANGE_BOTTOM:
+            self.range <<= 8
+            self.shift_low()
+
+    def flush(self):
+        for _ in range(5):
+            self.shift_low()
+        return self.result
+
+# decoder counterpart: get_freq(range_max) gives the cumulative count the next symbol covers,
+# the caller maps it to a symbol and then consumes it with decode(range_l, range_u, range_max)
+class RangeDecoder:
+    def __init__(self, data):
+        self.data = data
+        self.index = 5
+        self.range = RANGE_TOP - 1
+        self.code = int.from_bytes(bytes(data[:5]).ljust(5, b'\0'), 'big')
+        self.r = 0
+
+    def get_freq(self, range_max):
+        if range_max > RANGE_BOTTOM:
+            raise ValueError('total count {} does not fit the range coder'.format(range_max))
+        self.r = self.range // range_max
+        return min(self.code // self.r, range_max - 1)
+
+    def decode(self, range_l, range_u, range_max):
+        if not 0 <= range_l < range_u <= range_max <= RANGE_BOTTOM:
+            raise ValueError('interval [{}, {}) of {} is empty or does not fit the range coder'.format(range_l, range_u, range_max))
+        r = self.r
+        self.code -= r * range_l
+        self.range = r * (range_u - range_l)
+        while self.range < RANGE_BOTTOM:
+            b = self.data[self.index] if self.index < len(self.data) else 0
+            self.index += 1
+            self.code = ((self.code << 8) | b) & (RANGE_TOP - 1)
+            self.range <<= 8
+
+def encode_range(cum_count, sequence):
+    if cum_count[-1] > RANGE_BOTTOM:
+        raise ValueError('total count {} does not fit the range coder'.format(cum_count[-1]))
 
-class ArithmeticTestCase(unittest.TestCase):
-    def test_utils(self):
-        self.assertEqual(get_min_word_len([40, 1, 9]), 8)
+    total_count = cum_count[-1]
+    encoder = RangeEncoder()
+    for symbol in sequence:
+        encoder.encode(cum_count[symbol], cum_count[symbol + 1], total_count)
+    return encoder.flush()
 
-    def test_encode_decode_book(self):
-        counts = [40, 1, 9]
-        enc = encode(get_cum_count(counts), get_min_word_len(counts), [0, 2, 1, 0])
-        self.assertEqual(enc, [1, 1, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0])
+def decode_range(cum_count, data, dec_len, lookup = None):
+    if cum_count[-1] > RANGE_BOTTOM:
+        raise ValueError('total count {} does not fit the range coder'.format(cum_count[-1]))
 
-        dec = decode(get_cum_count(counts), get_min_word_len(counts), enc, 4)
-        self.assertEqual(dec, [0, 2, 1, 0])
+    if lookup is None:
+        lookup = build_symbol_lookup(cum_count)
 
+    result = []
+    total_count = cum_count[-1]
+    decoder = RangeDecoder(data)
+    while len(result) < dec_len:
+        symbol = lookup(decoder.get_freq(total_count))
+        decoder.decode(cum_count[symbol], cum_count[symbol + 1], total_count)
+        result.append(symbol)
+    return result
 
-    def _test_series(self, counts, series):
-        C = get_cum_count(counts)
-        m = get_min_word_len(counts)
+# binary indexed tree over symbol counts: prefix sums and updates in O(log n),
+# find walks down the implicit tree to the symbol covering a cumulative count
+class FenwickTree:
+    def __init__(self, counts):
+        n = len(counts)
+        tree = [0] + list(counts)
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.tree = tree
+        self.size = n
+        self.top = 1 << (n.bit_length() - 1) if n > 0 else 0
+
+    def add(self, symbol, delta):
+        tree = self.tree
+        i = symbol + 1
+        while i <= self.size:
+            tree[i] += delta
+            i += i & -i
+
+    # sum of the counts of symbols below symbol
+    def prefix(self, symbol):
+        tree = self.tree
+        result = 0
+        i = symbol
+        while i > 0:
+            result += tree[i]
+            i &= i - 1
+        return result
+
+    # returns (symbol, prefix(symbol)) for the symbol with prefix(symbol) <= C < prefix(symbol + 1)
+    def find(self, C):
+        tree = self.tree
+        n = self.size
+        pos = 0
+        low = 0
+        step = self.top
+        while step:
+            i = pos + step
+            if i <= n and low + tree[i] <= C:
+                pos = i
+                low += tree[i]
+            step >>= 1
+        return (pos, low)
+
+# order-0 model that learns as it goes: every symbol starts with a count of 1 and gains increment
+# each time it is coded, once the total passes limit all counts are halved (which also lets the
+# model follow drifting statistics)
+class AdaptiveModel:
+    def __init__(self, alphabet_size, increment = 24, limit = 1 << 16):
+        if alphabet_size > limit // 2 or limit > RANGE_BOTTOM:
+            raise ValueError('alphabet of {} symbols does not fit a total of {}'.format(alphabet_size, limit))
+
+        self.increment = increment
+        self.limit = limit
+        self.counts = [1] * alphabet_size
+        self.total = alphabet_size
+        self.tree = FenwickTree(self.counts)
+        self.rescales = 0
+
+    def interval(self, symbol):
+        range_l = self.tree.prefix(symbol)
+        return (range_l, range_l + self.counts[symbol])
+
+    def find(self, C):
+        (symbol, range_l) = self.tree.find(C)
+        return (symbol, range_l, range_l + self.counts[symbol])
+
+    def update(self, symbol):
+        self.counts[symbol] += self.increment
+        self.tree.add(symbol, self.increment)
+        self.total += self.increment
+        if self.total > self.limit:
+            self.rescale()
+
+    def rescale(self):
+        self.counts = [(c + 1) >> 1 for c in self.counts]
+        self.total = sum(self.counts)
+        self.tree = FenwickTree(self.counts)
+        self.rescales += 1
+
+# single pass coding, no table has to be sent: the decoder mirrors the encoder's model updates
+def encode_adaptive(alphabet_size, sequence, increment = 24, limit = 1 << 16):
+    model = AdaptiveModel(alphabet_size, increment, limit)
+    encoder = RangeEncoder()
+    for symbol in sequence:
+        (range_l, range_u) = model.interval(symbol)
+        encoder.encode(range_l, range_u, model.total)
+        model.update(symbol)
+    return encoder.flush()
+
+def decode_adaptive(alphabet_size, data, dec_len, increment = 24, limit = 1 << 16):
+    model = AdaptiveModel(alphabet_size, increment, limit)
+    decoder = RangeDecoder(data)
+    result = []
+    while len(result) < dec_len:
+        (symbol, range_l, range_u) = model.find(decoder.get_freq(model.total))
+        decoder.decode(range_l, range_u, model.total)
+        model.update(symbol)
+        result.append(symbol)
+    return result
 
-        for s in series:
-            enc = encode(C, m, s)
-            dec = decode(C, m, enc, len(s))
+# block parallel mode: the input is cut into chunks range coded independently with the shared model, so
+# they can go to separate processes, framed with utils.pack_frame
+def encode_chunk(cum_count, sequence):
+    return (len(sequence), bytes(encode_range(cum_count, sequence)))
 
-            self.assertEqual(dec, s)
+def decode_chunk(cum_count, chunk):
+    (n_symbols, data) = chunk
+    return decode_range(cum_count, data, n_symbols)
+
+def encode_parallel(cum_count, sequence, chunk_size = 1 << 16, max_workers = None):
+    chunks = [sequence[i:i + chunk_size] for i in range(0, len(sequence), chunk_size)]
+    return pack_frame(map_chunks(functools.partial(encode_chunk, cum_count), chunks, max_workers))
+
+def decode_parallel(cum_count, data, max_workers = None):
+    result = []
+    for decoded in map_chunks(functools.partial(decode_chunk, cum_count), unpack_frame(data), max_workers):
+        result.extend(decoded)
+    return result
+
+import unittest
+import random
+import struct
 
+# round trip cases shared by every coder driven by get_cum_count tables,
+# subclasses provide _test_series(counts, series)
+class RoundTripCases:
     def test_encode_decode(self):
         self._test_series([1, 2], [[0, 0], [1, 1], [0, 1], [1, 0]])
         self._test_series([40, 1, 9], [[0], [1], [0, 1], [1, 0], [0, 1, 1, 0]])
@@ -222,3 +435,177 @@ class ArithmeticTestCase(unittest.TestCase):
             s.append(x)
 
         self._test_series(counts, [s])
+
+class ArithmeticTestCase(RoundTripCases, unittest.TestCase):
+    def test_utils(self):
+        self.assertEqual(get_min_word_len([40, 1, 9]), 8)
+
+    def test_encode_decode_book(self):
+        counts = [40, 1, 9]
+        enc = encode(get_cum_count(counts), get_min_word_len(counts), [0, 2, 1, 0])
+        self.assertEqual(enc, [1, 1, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0])
+
+        dec = decode(get_cum_count(counts), get_min_word_len(counts), enc, 4)
+        self.assertEqual(dec, [0, 2, 1, 0])
+
+
+    def _test_series(self, counts, series):
+        C = get_cum_count(counts)
+        m = get_min_word_len(counts)
+
+        for s in series:
+            enc = encode(C, m, s)
+            dec = decode(C, m, enc, len(s))
+
+            self.assertEqual(dec, s)
+
+            enc = encode_range(C, s)
+            dec = decode_range(C, enc, len(s))
+
+            self.assertEqual(dec, s)
+
+    def test_range_coder(self):
+        counts = [40, 1, 9]
+        enc = encode_range(get_cum_count(counts), [0, 2, 1, 0])
+        self.assertEqual(type(enc), bytearray)
+        self.assertEqual(decode_range(get_cum_count(counts), enc, 4), [0, 2, 1, 0])
+
+        # runs of the most likely symbol push low up to 0xff.. and force carries
+        counts = [1 << 20, 1]
+        C = get_cum_count(counts)
+        for n in [0, 1, 100, 10000]:
+            s = [0] * n + [1] + [0] * n
+            self.assertEqual(decode_range(C, encode_range(C, s), len(s)), s)
+
+        # close to the limit the coder still has to round trip
+        counts = [RANGE_BOTTOM - 3, 1, 1, 1]
+        s = [0, 1, 2, 3, 3, 2, 1, 0] * 10
+        C = get_cum_count(counts)
+        self.assertEqual(decode_range(C, encode_range(C, s), len(s)), s)
+
+        with self.assertRaises(ValueError):
+            encode_range(get_cum_count([RANGE_BOTTOM, 1]), [0])
+        self.assertRaises(ValueError, RangeEncoder().encode, 0, 1, RANGE_BOTTOM + 1)
+        self.assertRaises(ValueError, RangeDecoder(bytes(5)).get_freq, RANGE_BOTTOM + 1)
+        self.assertRaises(ValueError, RangeDecoder(bytes(5)).decode, 0, 1, RANGE_BOTTOM + 1)
+
+        # an empty or out of range interval would leave range at 0 and loop forever
+        with self.assertRaises(ValueError):
+            encode_range([0, 0, 3], [0])
+        for (range_l, range_u, range_max) in [(2, 2, 3), (3, 2, 3), (-1, 1, 3), (2, 4, 3)]:
+            self.assertRaises(ValueError, RangeEncoder().encode, range_l, range_u, range_max)
+            decoder = RangeDecoder(bytes(5))
+            decoder.get_freq(range_max)
+            self.assertRaises(ValueError, decoder.decode, range_l, range_u, range_max)
+
+    def test_symbol_lookup(self):
+        C = get_cum_count([2, 0, 3, 1, 0])
+        expected = [0, 0, 2, 2, 2, 3]
+        table = build_symbol_lookup(C)
+        search = build_symbol_lookup(C, limit = 0)
+        for c in range(C[-1]):
+            self.assertEqual(table(c), expected[c])
+            self.assertEqual(search(c), expected[c])
+
+        random.seed(2)
+        counts = [random.randint(0, 3) for _ in range(1000)]
+        counts[-1] += 1
+        C = get_cum_count(counts)
+        s = [x for x in range(len(counts)) if counts[x] > 0] * 3
+        random.shuffle(s)
+        enc = encode_range(C, s)
+        self.assertEqual(decode_range(C, enc, len(s), build_symbol_lookup(C, limit = 0)), s)
+        self.assertEqual(decode_range(C, enc, len(s)), s)
+
+        m = get_min_word_len(counts)
+        self.assertEqual(decode(C, m, encode(C, m, s), len(s), build_symbol_lookup(C, limit = 0)), s)
+
+    def test_range_coder_size(self):
+        random.seed(1)
+        counts = [1] * 16
+        s = []
+        for _ in range(10000):
+            x = math.floor(random.betavariate(5, 1) * 16)
+            counts[x] += 1
+            s.append(x)
+
+        C = get_cum_count(counts)
+        bits = len(encode(C, get_min_word_len(counts), s))
+        # bytes instead of bits, but the same model: within a few bytes of the bit-wise coder
+        self.assertLessEqual(len(encode_range(C, s)) * 8, bits + 64)
+
+    def test_fenwick_tree(self):
+        random.seed(3)
+        for n in [1, 2, 7, 8, 100]:
+            counts = [random.randint(1, 5) for _ in range(n)]
+            tree = FenwickTree(counts)
+            for _ in range(50):
+                s = random.randrange(n)
+                counts[s] += 3
+                tree.add(s, 3)
+
+            C = get_cum_count(counts)
+            for s in range(n + 1):
+                self.assertEqual(tree.prefix(s), C[s])
+            for c in range(C[-1]):
+                (s, low) = tree.find(c)
+                self.assertTrue(C[s] <= c < C[s + 1])
+                self.assertEqual(low, C[s])
+
+    def test_adaptive(self):
+        for s in [[], [0], [3, 3, 3, 0], list(range(256)) * 2]:
+            self.assertEqual(decode_adaptive(256, encode_adaptive(256, s), len(s)), s)
+
+        random.seed(4)
+        alphabet_size = 16
+        counts = [1] * alphabet_size
+        s = []
+        for _ in range(20000):
+            x = math.floor(random.betavariate(5, 1) * alphabet_size)
+            counts[x] += 1
+            s.append(x)
+
+        enc = encode_adaptive(alphabet_size, s)
+        self.assertEqual(decode_adaptive(alphabet_size, enc, len(s)), s)
+
+        # one pass and no table, but close to the static model built from the whole input
+        static = encode_range(get_cum_count(counts), s)
+        self.assertLess(len(enc), len(static) * 1.03)
+
+        # a small limit forces rescaling on both sides
+        enc = encode_adaptive(alphabet_size, s, limit = 1 << 10)
+        self.assertEqual(decode_adaptive(alphabet_size, enc, len(s), limit = 1 << 10), s)
+
+        model = AdaptiveModel(alphabet_size, limit = 1 << 10)
+        for x in s:
+            model.update(x)
+        self.assertGreater(model.rescales, 0)
+        self.assertLessEqual(model.total, 1 << 10)
+
+        with self.assertRaises(ValueError):
+            AdaptiveModel(1 << 16)
+
+    def test_parallel(self):
+        random.seed(5)
+        alphabet_size = 7
+        counts = [1] * alphabet_size
+        s = []
+        for _ in range(5000):
+            x = math.floor(random.betavariate(5, 1) * alphabet_size)
+            counts[x] += 1
+            s.append(x)
+        C = get_cum_count(counts)
+
+        self.assertEqual(decode_parallel(C, encode_parallel(C, [], max_workers = 1), max_workers = 1), [])
+
+        enc = encode_parallel(C, s, 1000, max_workers = 1)
+        self.assertEqual(struct.unpack_from('>III', enc), (5, 1000, len(encode_range(C, s[:1000]))))
+        self.assertEqual(len(enc), 4 + 8 * 5 + sum(len(encode_range(C, s[i:i + 1000])) for i in range(0, 5000, 1000)))
+        self.assertEqual(decode_parallel(C, enc, max_workers = 1), s)
+
+        # chunks do not depend on the worker they ran on
+        self.assertEqual(encode_parallel(C, s, 1000, max_workers = 2), enc)
+        self.assertEqual(decode_parallel(C, enc, max_workers = 2), s)
+
+        enc = encode_parallel(C, s, 999, max_workers = 1)
+        self.assertEqual(decode_parallel(C, enc, max_workers = 1), s)
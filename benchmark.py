@@ -0,0 +1,489 @@
+import random
+import time
+
+def measure(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return (result, time.perf_counter() - start)
+
+def report(name, n, elapsed):
+    print('{:40} {:10.3f}s {:14.0f} symbols/s'.format(name, elapsed, n / elapsed))
+
+def betavariate_sequence(n, alphabet_size, seed = 0):
+    random.seed(seed)
+    return [int(random.betavariate(1, 5) * alphabet_size) for _ in range(n)]
+
+def text_sequence(n, vocabulary_size = 2000, seed = 0):
+    random.seed(seed)
+    letters = 'etaoinshrdlucmfwypvbgkjqxz'
+    vocabulary = [''.join(letters[int(random.betavariate(1, 3) * 26)] for _ in range(1 + int(random.betavariate(2, 5) * 12))) for _ in range(vocabulary_size)]
+    words = []
+    length = 0
+    while length < n:
+        words.append(vocabulary[int(random.betavariate(1, 8) * vocabulary_size)])
+        length += len(words[-1]) + 1
+    return ' '.join(words)[:n]
+
+def bench_huffman_decode(n = 200000):
+    import huffman
+    from utils import build_frequency
+
+    sequence = betavariate_sequence(n, 50)
+    code = huffman.build_huffman_code(build_frequency(sequence))
+    e = huffman.encode(code, sequence)
+
+    (dec, t) = measure(huffman.decode, code, e)
+    assert dec == sequence
+    report('huffman decode (tree walk)', n, t)
+
+    for k in [4, 8, 11]:
+        table = huffman.build_decode_table(code, k)
+        (dec, t) = measure(huffman.decode_table, table, e)
+        assert dec == sequence
+        report('huffman decode_table (k={})'.format(k), n, t)
+
+def bench_huffman_packed(sizes = [250000, 1000000, 4000000]):
+    import sys
+    import huffman
+    from utils import build_frequency
+
+    for n in sizes:
+        sequence = betavariate_sequence(n, 50)
+        code = huffman.build_huffman_code(build_frequency(sequence))
+
+        (e, t) = measure(huffman.encode, code, sequence)
+        report('huffman encode (n={})'.format(n), n, t)
+        ((data, n_bits), t) = measure(huffman.encode_packed, code, sequence)
+        report('huffman encode_packed (n={})'.format(n), n, t)
+        print('    output {} bytes as str, {} bytes packed'.format(sys.getsizeof(e), sys.getsizeof(data)))
+
+        (dec, t) = measure(huffman.decode_packed, huffman.build_decode_table(code), data, n_bits)
+        assert dec == sequence
+        report('huffman decode_packed (n={})'.format(n), n, t)
+
+def bench_huffman_array(n = 1000000):
+    import numpy as np
+    import huffman
+    from utils import build_frequency
+
+    sequence = betavariate_sequence(n, 50)
+    array = np.array(sequence, dtype = np.uint8)
+    code = huffman.build_huffman_code(build_frequency(sequence))
+
+    (e, t) = measure(huffman.encode, code, sequence)
+    report('huffman encode (n={})'.format(n), n, t)
+    (packed, t) = measure(huffman.encode_packed, code, sequence)
+    report('huffman encode_packed (n={})'.format(n), n, t)
+    (result, t) = measure(huffman.encode_array, code, array)
+    assert result == packed
+    report('huffman encode_array (n={})'.format(n), n, t)
+
+def bench_lz77(n = 1 << 18, brute_force_n = 1 << 12):
+    import functools
+    import lz77
+
+    sequence = text_sequence(brute_force_n)
+    (e, t) = measure(lz77.encode, sequence, 1 << 15)
+    report('lz77 brute force (S=32K, n={})'.format(brute_force_n), brute_force_n, t)
+
+    sequence = text_sequence(n)
+    for S in [1 << 15, 1 << 20]:
+        for max_chain in [8, 128]:
+            finder = functools.partial(lz77.HashChainMatchFinder, max_chain = max_chain)
+            (e, t) = measure(lz77.encode, sequence, S, finder)
+            assert lz77.decode(e) == sequence
+            report('lz77 hash chain (S={}K, chain={})'.format(S >> 10, max_chain), n, t)
+            print('    {} tokens'.format(len(e)))
+
+def bench_lz77_repetitive(n = 1 << 17):
+    import functools
+    import lz77
+
+    random.seed(0)
+    block = ''.join(random.choice('ab') for _ in range(4096))
+    inputs = [
+        ('text', text_sequence(n)),
+        ('a * n', 'a' * n),
+        ('4K binary block repeated', (block * (n // len(block) + 1))[:n]),
+        ('text with periodic noise', ''.join(c if k % 97 else 'x' for (k, c) in enumerate((text_sequence(8192) * (n // 8192 + 1))[:n]))),
+        ('random binary', ''.join(random.choice('ab') for _ in range(n // 4)))]
+    finders = [
+        ('hash chain', functools.partial(lz77.HashChainMatchFinder, max_chain = 4096, good_len = 273)),
+        ('binary tree', functools.partial(lz77.BinaryTreeMatchFinder, max_depth = 48, good_len = 273))]
+
+    for (name, sequence) in inputs:
+        for (finder_name, finder) in finders:
+            (e, t) = measure(lz77.encode, sequence, 1 << 22, finder)
+            assert lz77.decode(e) == sequence
+            report('lz77 {} (S=4M, {})'.format(finder_name, name), len(sequence), t)
+            print('    {} tokens'.format(len(e)))
+
+def bench_lz77_levels(n = 1 << 16):
+    import lz77
+
+    sequence = text_sequence(n)
+    for level in sorted(lz77.LEVELS):
+        (e, t) = measure(lz77.encode_level, sequence, level)
+        assert lz77.decode(e) == sequence
+        report('lz77 level {}'.format(level), n, t)
+        print('    {} tokens, {} bits'.format(len(e), sum(lz77.token_price(o, l) for (o, l, c) in e)))
+
+def bench_lz77_decode(n = 1 << 20):
+    import lz77
+
+    sequence = text_sequence(n // 4) * 4
+    e = lz77.encode_level(sequence, 2)
+    (dec, t) = measure(lz77.decode, e)
+    assert dec == sequence
+    report('lz77 decode (str, {} tokens)'.format(len(e)), n, t)
+
+    data = sequence.encode()
+    e = lz77.encode_level(data, 2)
+    (dec, t) = measure(lz77.decode_bytes, e)
+    assert dec == data
+    report('lz77 decode_bytes ({} tokens)'.format(len(e)), n, t)
+
+    e = [(0, 0, 97), (1, n - 2, 98)]
+    (dec, t) = measure(lz77.decode, [(o, l, chr(c)) for (o, l, c) in e])
+    report('lz77 decode (str, run)', n, t)
+    (dec, t) = measure(lz77.decode_bytes, e)
+    report('lz77 decode_bytes (run)', n, t)
+
+def bench_lz77_stream(n = 1 << 20, chunk = 1 << 12):
+    import lz77
+
+    data = text_sequence(n).encode()
+    for S in [1 << 12, 1 << 15]:
+        encoder = lz77.StreamEncoder(S)
+        decoder = lz77.StreamDecoder(S)
+        peak = 0
+        decoded = []
+
+        start = time.perf_counter()
+        for i in range(0, n, chunk):
+            tokens = encoder.feed(data[i:i + chunk])
+            if tokens:
+                decoded.append(decoder.feed(tokens))
+            peak = max(peak, len(encoder.buffer or b''))
+        decoded.append(decoder.feed(encoder.flush()))
+        t = time.perf_counter() - start
+
+        assert b''.join(decoded) == data
+        report('lz77 stream (S={}K, {}K chunks)'.format(S >> 10, chunk >> 10), n, t)
+        print('    peak encoder buffer {} bytes for {} bytes of input'.format(peak, n))
+
+def bench_lz78_encode(sizes = [1 << 16, 1 << 18, 1 << 20]):
+    import lz78
+
+    for n in sizes:
+        for (name, sequence) in [('a * n', 'a' * n), ('text', text_sequence(n // 16) * 16)]:
+            (e, t) = measure(lz78.encode, sequence)
+            report('lz78 encode (n={}, {})'.format(n, name), n, t)
+
+def bench_lz78_decode(n = 1 << 20):
+    import tracemalloc
+    import lz78
+
+    for (name, sequence) in [('a * n', 'a' * n), ('text', text_sequence(n // 16) * 16)]:
+        e = lz78.encode(sequence)
+        tracemalloc.start()
+        (dec, t) = measure(lz78.decode, e)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert dec == sequence
+        report('lz78 decode (n={}, {})'.format(n, name), n, t)
+        print('    {} phrases, peak {} bytes'.format(len(e), peak))
+
+def bench_lz78_policies(n = 1 << 19, max_size = 1 << 12):
+    import lz78
+
+    # the vocabulary changes every quarter of the input
+    sequence = ''.join(text_sequence(n // 4, seed = seed) for seed in range(4))
+    for policy in ['freeze', 'reset', 'monitor', 'lru']:
+        (e, t) = measure(lz78.encode, sequence, max_size, policy)
+        report('lz78 encode ({}, max_size={})'.format(policy, max_size), n, t)
+        (dec, t) = measure(lz78.decode, e, max_size, policy)
+        assert dec == sequence
+        report('lz78 decode ({}, max_size={})'.format(policy, max_size), n, t)
+        print('    {} tokens'.format(len(e)))
+
+def bench_lzw(n = 1 << 20):
+    import pickle
+    import lz78
+
+    sequence = text_sequence(n)
+    data = sequence.encode()
+    tokens = lz78.encode(sequence)
+    print('lz78 tokens: {} tokens, {} bytes pickled'.format(len(tokens), len(pickle.dumps(tokens))))
+
+    for max_size in [None, 1 << 12]:
+        (e, t) = measure(lz78.encode_lzw, data, max_size)
+        report('lzw encode (max_size={})'.format(max_size), n, t)
+        (dec, t) = measure(lz78.decode_lzw, e, max_size)
+        assert dec == data
+        report('lzw decode (max_size={})'.format(max_size), n, t)
+        print('    {} bytes for {} bytes of input'.format(len(e), n))
+
+def bench_arithmetic(n = 200000, alphabet_size = 10):
+    import artihmetic
+
+    sequence = betavariate_sequence(n, alphabet_size)
+    counts = [1] * alphabet_size
+    for s in sequence:
+        counts[s] += 1
+    C = artihmetic.get_cum_count(counts)
+    m = artihmetic.get_min_word_len(counts)
+
+    (e, t) = measure(artihmetic.encode, C, m, sequence)
+    report('arithmetic encode (bitwise)', n, t)
+    (dec, t) = measure(artihmetic.decode, C, m, e, n)
+    assert dec == sequence
+    report('arithmetic decode (bitwise)', n, t)
+
+    (data, t) = measure(artihmetic.encode_range, C, sequence)
+    report('arithmetic encode_range', n, t)
+    (dec, t) = measure(artihmetic.decode_range, C, data, n)
+    assert dec == sequence
+    report('arithmetic decode_range', n, t)
+    print('    {} bits vs {} bytes'.format(len(e), len(data)))
+
+def bench_arithmetic_lookup(n = 50000, alphabets = [10, 256, 65536]):
+    import artihmetic
+
+    def linear_lookup(cum_count):
+        def lookup(C):
+            symbol = 0
+            while C >= cum_count[symbol + 1]:
+                symbol = symbol + 1
+            return symbol
+        return lookup
+
+    for alphabet_size in alphabets:
+        sequence = betavariate_sequence(n, alphabet_size)
+        counts = [1] * alphabet_size
+        for s in sequence:
+            counts[s] += 1
+        C = artihmetic.get_cum_count(counts)
+        data = artihmetic.encode_range(C, sequence)
+
+        lookups = [('bisect', artihmetic.build_symbol_lookup(C, limit = 0))]
+        if C[-1] <= artihmetic.DIRECT_LOOKUP_LIMIT:
+            lookups.append(('table', artihmetic.build_symbol_lookup(C)))
+        if alphabet_size <= 256:
+            lookups.append(('linear', linear_lookup(C)))
+
+        for (name, lookup) in lookups:
+            (dec, t) = measure(artihmetic.decode_range, C, data, n, lookup)
+            assert dec == sequence
+            report('decode_range {} (alphabet={})'.format(name, alphabet_size), n, t)
+
+def bench_arithmetic_adaptive(n = 200000, alphabets = [10, 256]):
+    import artihmetic
+
+    for alphabet_size in alphabets:
+        sequence = betavariate_sequence(n, alphabet_size)
+        counts = [1] * alphabet_size
+        for s in sequence:
+            counts[s] += 1
+        static = artihmetic.encode_range(artihmetic.get_cum_count(counts), sequence)
+
+        (data, t) = measure(artihmetic.encode_adaptive, alphabet_size, sequence)
+        report('encode_adaptive (alphabet={})'.format(alphabet_size), n, t)
+        (dec, t) = measure(artihmetic.decode_adaptive, alphabet_size, data, n)
+        assert dec == sequence
+        report('decode_adaptive (alphabet={})'.format(alphabet_size), n, t)
+        print('    adaptive {} bytes, static {} bytes + table'.format(len(data), len(static)))
+
+def bench_ans(n = 1000000, alphabet_size = 10):
+    import ans
+    import artihmetic
+
+    sequence = betavariate_sequence(n, alphabet_size)
+    counts = [1] * alphabet_size
+    for s in sequence:
+        counts[s] += 1
+    C = artihmetic.get_cum_count(counts)
+
+    (data, t) = measure(artihmetic.encode_range, C, sequence)
+    report('arithmetic encode_range', n, t)
+    (data, t) = measure(ans.encode_rans, C, sequence)
+    report('rans encode (4 states)', n, t)
+    (dec, t) = measure(ans.decode_rans, C, data, n)
+    assert dec == sequence
+    report('rans decode (4 states)', n, t)
+
+    tables = ans.build_tans_tables(C)
+    (data, t) = measure(ans.encode_tans, tables, sequence)
+    report('tans encode (4 states)', n, t)
+    (dec, t) = measure(ans.decode_tans, tables, data, n)
+    assert dec == sequence
+    report('tans decode (4 states)', n, t)
+
+    if ans.np is not None:
+        for n_states in [64, 1024]:
+            (data, t) = measure(ans.encode_rans_array, C, sequence, n_states)
+            report('rans encode_array ({} states)'.format(n_states), n, t)
+            (dec, t) = measure(ans.decode_rans_array, C, data, n, n_states)
+            assert dec.tolist() == sequence
+            report('rans decode_array ({} states)'.format(n_states), n, t)
+
+def bench_arithmetic_parallel(n = 1000000, alphabet_size = 10, workers = [1, 2, 4]):
+    import os
+    import artihmetic
+
+    sequence = betavariate_sequence(n, alphabet_size)
+    counts = [1] * alphabet_size
+    for s in sequence:
+        counts[s] += 1
+    C = artihmetic.get_cum_count(counts)
+
+    print('    {} cpus'.format(os.cpu_count()))
+    for max_workers in workers:
+        (data, t) = measure(artihmetic.encode_parallel, C, sequence, 1 << 16, max_workers)
+        report('encode_parallel ({} workers)'.format(max_workers), n, t)
+        (dec, t) = measure(artihmetic.decode_parallel, C, data, max_workers)
+        assert dec == sequence
+        report('decode_parallel ({} workers)'.format(max_workers), n, t)
+
+def bench_ppm(n = 1 << 15, orders = [1, 2, 4]):
+    import ppm
+
+    sequence = text_sequence(n)
+    for alphabet in ['etaoinshrdlucmfwypvbgkjqxz ', ''.join(map(chr, range(256)))]:
+        for max_context_len in orders:
+            name = '(order {}, alphabet {})'.format(max_context_len, len(alphabet))
+            (data, t) = measure(ppm.encode, sequence, max_context_len, alphabet)
+            report('ppm encode ' + name, n, t)
+            (dec, t) = measure(ppm.decode, data, max_context_len, alphabet, n)
+            assert dec == sequence
+            report('ppm decode ' + name, n, t)
+            print('    {} bytes, {:.3f} bits/symbol'.format(len(data), len(data) * 8 / n))
+
+def bench_ppm_memory(n = 1 << 16, max_context_len = 5):
+    import sys
+    import ppm
+
+    sequence = text_sequence(n)
+    alphabet = 'etaoinshrdlucmfwypvbgkjqxz '
+    tree = ppm.ContextTree(len(alphabet), max_context_len)
+    for s in sequence:
+        tree.update(alphabet.index(s))
+
+    contexts = [0] * (max_context_len + 1)
+    counts = [0] * (max_context_len + 1)
+    todo = [tree.root]
+    while todo:
+        node = todo.pop()
+        contexts[node.order] += 1
+        counts[node.order] += node.counts.memory_usage()
+        todo.extend((node.children or {}).values())
+
+    # what CountArraySparse in every context would take
+    full = sys.getsizeof(ppm.CountArraySparse(len(alphabet))) + 2 * sys.getsizeof([0] * len(alphabet))
+    for (order, usage) in enumerate(tree.memory_usage()):
+        print('ppm order {} {:6} contexts {:9} bytes, counts {:9} bytes ({:9} as CountArraySparse)'.format(order, contexts[order], usage, counts[order], contexts[order] * full))
+
+def bench_ppm_bounded(n = 1 << 16, max_context_len = 4, budgets = [1 << 10, 1 << 12]):
+    import ppm
+
+    sequence = text_sequence(n)
+    alphabet = 'etaoinshrdlucmfwypvbgkjqxz '
+    (data, t) = measure(ppm.encode, sequence, max_context_len, alphabet)
+    tree = ppm.ContextTree(len(alphabet), max_context_len)
+    for s in sequence:
+        tree.update(alphabet.index(s))
+    report('ppm encode (unbounded)', n, t)
+    print('    {} bytes, {} contexts'.format(len(data), tree.size))
+
+    for max_contexts in budgets:
+        for policy in ppm.PPM_POLICIES:
+            tree = ppm.ContextTree(len(alphabet), max_context_len, max_contexts = max_contexts, policy = policy)
+            (data, t) = measure(ppm.encode, sequence, max_context_len, alphabet, tree)
+            report('ppm encode ({} contexts, {})'.format(max_contexts, policy), n, t)
+            print('    {} bytes, {} restarts, {} prunes removing {} contexts'.format(len(data), tree.restarts, tree.prunes, tree.pruned))
+
+def bench_ppm_model(n_records = 200, max_context_len = 3):
+    import os
+    import tempfile
+    import ppm
+
+    alphabet = 'etaoinshrdlucmfwypvbgkjqxz '
+    # train on the first part of the text, records are cut from the rest
+    text = text_sequence((1 << 18) + n_records * 2048)
+    corpus = text[:1 << 18]
+    records = []
+    random.seed(3)
+    for _ in range(n_records):
+        start = random.randrange(len(corpus), len(text) - 2048)
+        records.append(text[start:start + random.randint(100, 2048)])
+    n = sum(len(r) for r in records)
+
+    tree = ppm.train_model([corpus[i:i + 4096] for i in range(0, len(corpus), 4096)], max_context_len, alphabet)
+    (fd, path) = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(ppm.write_model(tree, alphabet))
+    (model, t) = measure(ppm.load_model, path)
+    print('    model {} bytes, {} contexts, loaded in {:.6f}s'.format(os.path.getsize(path), tree.size, t))
+
+    def code_all(f):
+        return [f(r) for r in records]
+
+    (cold, t) = measure(code_all, lambda r: ppm.encode(r, max_context_len, alphabet))
+    report('ppm encode records (no model)', n, t)
+    (warm, t) = measure(code_all, lambda r: ppm.encode_with_model(model, r))
+    report('ppm encode records (model)', n, t)
+    (dec, t) = measure(lambda: [ppm.decode_with_model(model, e, len(r)) for (e, r) in zip(warm, records)])
+    assert dec == records
+    report('ppm decode records (model)', n, t)
+    print('    {} records, {} bytes: {} bytes without model, {} with'.format(len(records), n, sum(map(len, cold)), sum(map(len, warm))))
+
+    ppm.close_model(model)
+    os.remove(path)
+
+def bench_ppm_blocks(n = 1 << 17, max_context_len = 3, workers = [1, 2, 4], block_sizes = [1 << 12, 1 << 14, 1 << 16]):
+    import os
+    import ppm
+
+    alphabet = 'etaoinshrdlucmfwypvbgkjqxz '
+    text = text_sequence(n + 1024)
+    (prefix, sequence) = (text[:1024], text[1024:])
+
+    print('    {} cpus'.format(os.cpu_count()))
+    for max_workers in workers:
+        (data, t) = measure(ppm.encode_blocks, sequence, max_context_len, alphabet, 1 << 14, '', max_workers)
+        report('ppm encode_blocks ({} workers)'.format(max_workers), n, t)
+        (dec, t) = measure(ppm.decode_blocks, data, max_context_len, alphabet, '', max_workers)
+        assert dec == sequence
+        report('ppm decode_blocks ({} workers)'.format(max_workers), n, t)
+
+    whole = len(ppm.encode(sequence, max_context_len, alphabet))
+    print('    single block {} bytes'.format(whole))
+    for block_size in block_sizes:
+        plain = len(ppm.encode_blocks(sequence, max_context_len, alphabet, block_size, '', 1))
+        primed = len(ppm.encode_blocks(sequence, max_context_len, alphabet, block_size, prefix, 1))
+        print('    block size {:6}: {} bytes (+{:.1f}%), with a {} symbol prefix {} bytes (+{:.1f}%)'.format(
+            block_size, plain, 100 * (plain - whole) / whole, len(prefix), primed, 100 * (primed - whole) / whole))
+
+if __name__ == '__main__':
+    bench_huffman_decode()
+    bench_huffman_packed()
+    bench_huffman_array()
+    bench_lz77()
+    bench_lz77_repetitive()
+    bench_lz77_levels()
+    bench_lz77_decode()
+    bench_lz77_stream()
+    bench_lz78_encode()
+    bench_lz78_decode()
+    bench_lz78_policies()
+    bench_lzw()
+    bench_arithmetic()
+    bench_arithmetic_lookup()
+    bench_arithmetic_adaptive()
+    bench_ans()
+    bench_arithmetic_parallel()
+    bench_ppm()
+    bench_ppm_memory()
+    bench_ppm_bounded()
+    bench_ppm_model()
+    bench_ppm_blocks()
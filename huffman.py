@@ -1,35 +1,196 @@
-from bisect import bisect_right
+from collections import deque
+from utils import BitWriter, BitReader
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# dense integer alphabets get a flat list indexed by symbol, sparse or
+# non-integer ones a dict, so tables are sized by the symbols actually present
+def make_lookup(symbols, default, size = 0):
+    if all(type(s) is int and s >= 0 for s in symbols):
+        n = max(symbols, default = -1) + 1
+        if n <= max(size, 2 * len(symbols)):
+            return [default] * max(size, n)
+    return dict.fromkeys(symbols, default)
+
+def lookup_items(lookup):
+    if isinstance(lookup, dict):
+        return lookup.items()
+    return enumerate(lookup)
 
 def build_huffman_code(frequency):
     frequency = sorted(frequency, key = lambda x: x[1])
-    sorted_freq = [freq for (s, freq) in frequency]
-    sorted_nodes = [[s, None, None ] for (s, freq) in frequency]
+    leaves = deque((freq, [s, None, None]) for (s, freq) in frequency)
+    nodes = deque()
 
-    while(len(sorted_freq) > 1):
-        freq0, l = (sorted_freq.pop(0), sorted_nodes.pop(0))
-        freq1, r = (sorted_freq.pop(0), sorted_nodes.pop(0))
+    # on ties leaves go first, merged nodes are created in nondecreasing order
+    def pop_smallest():
+        if not nodes or (leaves and leaves[0][0] <= nodes[0][0]):
+            return leaves.popleft()
+        return nodes.popleft()
 
-        node = (freq0 + freq1, [None, l, r])
-        i = bisect_right(sorted_freq, node[0])
+    while len(leaves) + len(nodes) > 1:
+        freq0, l = pop_smallest()
+        freq1, r = pop_smallest()
+        nodes.append((freq0 + freq1, [None, l, r]))
 
-        sorted_freq.insert(i, node[0])
-        sorted_nodes.insert(i, node[1])
+    lookup = make_lookup([s for (s, freq) in frequency], None, 256)
 
-    lookup = [None] * 256
-    def walk_tree(node, acc, lookup):
-        (s, l, r) = node
+    root = (leaves or nodes)[0][1]
+    stack = [(root, '')]
+    while stack:
+        ((s, l, r), acc) = stack.pop()
         if s != None:
             lookup[s] = acc
-        if l:
-            walk_tree(l, acc + '0', lookup)
         if r:
-            walk_tree(r, acc + '1', lookup)
+            stack.append((r, acc + '1'))
+        if l:
+            stack.append((l, acc + '0'))
+
+    return (root, lookup)
+
+# two-queue huffman over leaves sorted by frequency, internal nodes are created
+# in nondecreasing weight order so the smallest node is always at a queue head
+def build_code_lengths(frequency, max_len = None):
+    frequency = sorted(frequency, key = lambda x: x[1])
+    n = len(frequency)
+    lengths = make_lookup([s for (s, freq) in frequency], 0)
+
+    if n == 1:
+        lengths[frequency[0][0]] = 1
+        return lengths
+
+    weights = [freq for (s, freq) in frequency]
+    parent = [0] * (2 * n - 1)
+    i = 0
+    j = n
+
+    for k in range(n, 2 * n - 1):
+        children = []
+        for _ in range(2):
+            if j < k and (i == n or weights[j] < weights[i]):
+                children.append(j)
+                j = j + 1
+            else:
+                children.append(i)
+                i = i + 1
+        weights.append(weights[children[0]] + weights[children[1]])
+        parent[children[0]] = k
+        parent[children[1]] = k
+
+    depth = [0] * (2 * n - 1)
+    for k in range(2 * n - 3, -1, -1):
+        depth[k] = depth[parent[k]] + 1
+
+    if max_len is not None and max(depth[:n], default = 0) > max_len:
+        depth = package_merge(weights[:n], max_len)
 
-    root = sorted_nodes[0]
-    walk_tree(root, '', lookup)
+    for (k, (s, freq)) in enumerate(frequency):
+        lengths[s] = depth[k]
+
+    return lengths
+
+# weights must be sorted, returns code lengths in the same order
+def package_merge(weights, max_len):
+    n = len(weights)
+    if (1 << max_len) < n:
+        raise ValueError('{} symbols do not fit in codes of {} bits'.format(n, max_len))
+
+    # for every level only remember which merged items are leaves, leaves are
+    # always taken as a prefix of the sorted weights
+    levels = []
+    prev = []
+    for _ in range(max_len):
+        packages = [prev[k] + prev[k + 1] for k in range(0, len(prev) - 1, 2)]
+        merged = []
+        is_leaf = []
+        i = 0
+        j = 0
+        while i < n or j < len(packages):
+            if j == len(packages) or (i < n and weights[i] <= packages[j]):
+                merged.append(weights[i])
+                is_leaf.append(True)
+                i = i + 1
+            else:
+                merged.append(packages[j])
+                is_leaf.append(False)
+                j = j + 1
+        levels.append(is_leaf)
+        prev = merged
+
+    lengths = [0] * n
+    selected = 2 * n - 2
+    for is_leaf in reversed(levels):
+        leaves = sum(is_leaf[:selected])
+        for k in range(leaves):
+            lengths[k] += 1
+        selected = 2 * (selected - leaves)
+
+    return lengths
+
+# codes are assigned in (length, symbol) order, the tree is rebuilt so the
+# result can be used everywhere a build_huffman_code result is
+def build_canonical_code(lengths):
+    lookup = make_lookup(lengths, None) if isinstance(lengths, dict) else [None] * len(lengths)
+    root = [None, None, None]
+    code = 0
+    prev_len = 0
+
+    for (n, s) in sorted((n, s) for (s, n) in lookup_items(lengths) if n > 0):
+        code <<= n - prev_len
+        prev_len = n
+        c = format(code, '0{}b'.format(n))
+        lookup[s] = c
+        code = code + 1
+
+        node = root
+        for b in c:
+            child = 1 if b == '0' else 2
+            if node[child] is None:
+                node[child] = [None, None, None]
+            node = node[child]
+        node[0] = s
 
     return (root, lookup)
 
+def build_canonical_huffman_code(frequency, max_len = None):
+    return build_canonical_code(build_code_lengths(frequency, max_len))
+
+# dict-backed lengths are written as (symbol, length) pairs
+def write_code_lengths(writer, lengths):
+    sparse = isinstance(lengths, dict)
+    width = max([n for (s, n) in lookup_items(lengths)], default = 0).bit_length()
+    writer.write(int(sparse), 1)
+    writer.write(len(lengths), 32)
+    writer.write(width, 5)
+
+    if sparse:
+        symbol_width = max(lengths, default = 0).bit_length()
+        writer.write(symbol_width, 6)
+        for (s, n) in sorted(lengths.items()):
+            writer.write(s, symbol_width)
+            writer.write(n, width)
+    else:
+        for n in lengths:
+            writer.write(n, width)
+
+def read_code_lengths(reader):
+    sparse = reader.read(1)
+    count = reader.read(32)
+    width = reader.read(5)
+
+    if sparse:
+        symbol_width = reader.read(6)
+        lengths = dict()
+        for _ in range(count):
+            s = reader.read(symbol_width)
+            lengths[s] = reader.read(width)
+        return lengths
+
+    return [reader.read(width) for _ in range(count)]
+
 def encode(code, sequence):
     result = ''
 
@@ -61,6 +222,155 @@ def decode(code, sequence):
 
     return result
 
+# table entries are (symbol, length, None) for codes that end within the table
+# and (None, width, subtable) for prefixes of longer codes, subtables are indexed
+# by the next width bits
+def build_decode_table(code, k = 8):
+    def fill(codes, k):
+        table = [None] * (1 << k)
+        longer = dict()
+        for (s, c) in codes:
+            n = len(c)
+            if n <= k:
+                base = int(c, 2) << (k - n)
+                for j in range(1 << (k - n)):
+                    table[base + j] = (s, n, None)
+            else:
+                longer.setdefault(int(c[:k], 2), []).append((s, c[k:]))
+
+        for (prefix, tail) in longer.items():
+            width = min(k, max(len(c) for (s, c) in tail))
+            table[prefix] = (None, width, fill(tail, width))
+
+        return table
+
+    codes = [(s, c) for (s, c) in lookup_items(code[1]) if c]
+    max_len = max([len(c) for (s, c) in codes], default = 0)
+    return (k, max_len, fill(codes, k))
+
+def decode_table(table, sequence):
+    result = []
+    (k, max_len, primary) = table
+    n = len(sequence)
+    sequence = sequence + '0' * (k + max_len)
+    i = 0
+
+    while i < n:
+        (s, l, sub) = primary[int(sequence[i:i + k], 2)]
+        width = k
+        while sub:
+            i = i + width
+            width = l
+            (s, l, sub) = sub[int(sequence[i:i + width], 2)]
+        result.append(s)
+        i = i + l
+
+    return result
+
+def encode_packed(code, sequence):
+    codes = make_lookup(code[1], None) if isinstance(code[1], dict) else [None] * len(code[1])
+    for (s, c) in lookup_items(code[1]):
+        if c is not None:
+            codes[s] = (int(c, 2) if c else 0, len(c))
+    writer = BitWriter()
+
+    for s in sequence:
+        (value, n) = codes[s]
+        writer.write(value, n)
+
+    n_bits = writer.bit_count
+    return (writer.flush(), n_bits)
+
+def decode_packed(table, data, n_bits):
+    result = []
+    (k, max_len, primary) = table
+    reader = BitReader(data)
+
+    while reader.position < n_bits:
+        (s, l, sub) = primary[reader.peek(k)]
+        width = k
+        while sub:
+            reader.skip(width)
+            width = l
+            (s, l, sub) = sub[reader.peek(width)]
+        result.append(s)
+        reader.skip(l)
+
+    return result
+
+# produces the same bytes as encode_packed without a per-symbol python loop:
+# codes and lengths are gathered from tables, bit offsets come from a prefix
+# sum and codes are or-ed into 64-bit words, a code touches at most two words.
+# the array is processed in chunks so temporaries stay in cache
+def encode_array(code, array, chunk = 1 << 14):
+    if np is None:
+        raise ImportError('encode_array needs numpy')
+
+    lookup = code[1]
+    array = np.asarray(array).ravel()
+    codes = [(s, c) for (s, c) in lookup_items(lookup) if c is not None]
+
+    if len(array) == 0:
+        return (bytearray(), 0)
+    if max([len(c) for (s, c) in codes], default = 0) > 64:
+        raise ValueError('encode_array needs codes of at most 64 bits, use max_len')
+
+    if isinstance(lookup, dict):
+        codes.sort()
+        keys = np.array([s for (s, c) in codes])
+        slots = np.searchsorted(keys, array).clip(0, max(len(keys) - 1, 0))
+        known = len(keys) > 0 and (keys[slots] == array).all()
+        table_known = None
+    else:
+        # tables are indexed by the symbol itself
+        slots = array
+        known = array.min() >= 0 and array.max() < len(lookup)
+        table_known = np.zeros(len(lookup), dtype = bool)
+        table_known[[s for (s, c) in codes]] = True
+        codes = [(s, c if c is not None else '') for (s, c) in enumerate(lookup)]
+
+    if known and table_known is not None:
+        known = table_known[slots].all()
+    if not known:
+        raise ValueError('sequence contains symbols without a code')
+
+    table_values = np.array([int(c, 2) if c else 0 for (s, c) in codes], dtype = np.uint64)
+    table_lengths = np.array([len(c) for (s, c) in codes], dtype = np.uint64)
+
+    result = bytearray()
+    carry = np.uint64(0)
+    carry_bits = 0
+    n_bits = 0
+
+    for i in range(0, len(slots), chunk):
+        values = table_values[slots[i:i + chunk]]
+        lengths = table_lengths[slots[i:i + chunk]]
+        ends = np.cumsum(lengths) + np.uint64(carry_bits)
+        starts = ends - lengths
+        chunk_bits = int(ends[-1])
+
+        word = starts >> np.uint64(6)
+        end_in_word = (starts & np.uint64(63)) + lengths
+        spill = end_in_word > 64
+        right = np.where(spill, end_in_word - np.uint64(64), np.uint64(0))
+        left = np.where(spill, np.uint64(0), np.uint64(64) - end_in_word)
+        first = (values >> right) << left
+
+        words = np.zeros(chunk_bits // 64 + 1, dtype = np.uint64)
+        heads = np.flatnonzero(np.diff(word, prepend = np.uint64(word[0] + 1)))
+        words[word[heads]] = np.bitwise_or.reduceat(first, heads)
+        words[word[spill] + np.uint64(1)] |= values[spill] << (np.uint64(128) - end_in_word[spill])
+        words[0] |= carry
+
+        full = chunk_bits // 64
+        result += words[:full].astype('>u8').tobytes()
+        carry = words[full]
+        carry_bits = chunk_bits % 64
+        n_bits += chunk_bits - int(starts[0])
+
+    result += int(carry).to_bytes(8, 'big')[:(carry_bits + 7) // 8]
+    return (result, n_bits)
+
 import unittest
 import random
 from utils import get_average_codelength, build_frequency
@@ -100,4 +410,179 @@ class HuffmanTestCase(unittest.TestCase):
         f = build_frequency(sequence)
         code = build_huffman_code(f)
 
-        self.assertEqual(sequence, decode(code, encode(code, sequence)))
\ No newline at end of file
+        self.assertEqual(sequence, decode(code, encode(code, sequence)))
+
+    def test_decode_table(self):
+        alphabet_size = 50
+        random.seed(0)
+
+        sequence = []
+        for _ in range(1000):
+            sequence.append(int(random.betavariate(1, 5) * alphabet_size))
+
+        f = build_frequency(sequence)
+        code = build_huffman_code(f)
+        e = encode(code, sequence)
+
+        for k in [1, 2, 3, 8, 12]:
+            self.assertEqual(sequence, decode_table(build_decode_table(code, k), e))
+
+        freq = [(i, 1 << i) for i in range(20)]
+        code = build_huffman_code(freq)
+        sequence = list(range(20)) * 3
+        self.assertEqual(sequence, decode_table(build_decode_table(code, 4), encode(code, sequence)))
+
+    def test_encode_decode_packed(self):
+        alphabet_size = 50
+        random.seed(0)
+
+        sequence = []
+        for _ in range(1000):
+            sequence.append(int(random.betavariate(1, 5) * alphabet_size))
+
+        f = build_frequency(sequence)
+        code = build_huffman_code(f)
+        e = encode(code, sequence)
+        (data, n_bits) = encode_packed(code, sequence)
+
+        self.assertEqual(n_bits, len(e))
+        self.assertEqual(len(data), (len(e) + 7) // 8)
+        self.assertEqual(int.from_bytes(data, 'big') >> (len(data) * 8 - n_bits), int(e, 2))
+
+        for k in [2, 8]:
+            table = build_decode_table(code, k)
+            self.assertEqual(sequence, decode_packed(table, bytes(data), n_bits))
+            self.assertEqual(sequence, decode_packed(table, memoryview(data), n_bits))
+
+    def test_canonical(self):
+        freq = [(0, 4), (1, 2), (2, 2), (3, 1), (4, 1)]
+        code = build_canonical_huffman_code(freq)
+        self.assertAlmostEqual(get_average_codelength(code, freq), 2.2, 1)
+
+        freq = [(0, 95), (1, 2), (2, 3)]
+        code = build_canonical_huffman_code(freq)
+        self.assertAlmostEqual(get_average_codelength(code, freq), 1.05, 2)
+        self.assertEqual(code[1], ['0', '10', '11'])
+
+        code = build_canonical_huffman_code([(7, 3)])
+        self.assertEqual(code[1][7], '0')
+        self.assertEqual([7, 7, 7], decode(code, encode(code, [7, 7, 7])))
+
+    def test_length_limited(self):
+        freq = [(i, 1 << i) for i in range(20)]
+        self.assertEqual(max(build_code_lengths(freq)), 19)
+
+        for max_len in [5, 8, 12, 19]:
+            lengths = build_code_lengths(freq, max_len)
+            self.assertLessEqual(max(lengths), max_len)
+            self.assertEqual(sum(2 ** -n for n in lengths), 1)
+
+        self.assertEqual(build_code_lengths(freq, 19), build_code_lengths(freq))
+        self.assertEqual(package_merge([1, 1, 1, 1], 2), [2, 2, 2, 2])
+        self.assertEqual(package_merge([1, 1, 2, 4], 2), [2, 2, 2, 2])
+        self.assertEqual(package_merge([1, 1, 2, 4], 3), [3, 3, 2, 1])
+        self.assertRaises(ValueError, package_merge, [1] * 5, 2)
+
+        # limiting may only cost a little over the unlimited code
+        random.seed(0)
+        sequence = [int(random.betavariate(1, 5) * 200) for _ in range(10000)]
+        freq = build_frequency(sequence)
+        unlimited = get_average_codelength(build_huffman_code(freq), freq)
+        self.assertAlmostEqual(get_average_codelength(build_canonical_huffman_code(freq), freq), unlimited)
+        limited = build_canonical_huffman_code(freq, 9)
+        self.assertLess(get_average_codelength(limited, freq), unlimited * 1.05)
+        self.assertEqual(sequence, decode_table(build_decode_table(limited), encode(limited, sequence)))
+
+    def test_code_length_header(self):
+        random.seed(0)
+        sequence = [int(random.betavariate(1, 5) * 50) for _ in range(1000)]
+        code = build_canonical_huffman_code(build_frequency(sequence), 8)
+
+        writer = BitWriter()
+        write_code_lengths(writer, [len(c) if c else 0 for c in code[1]])
+        for s in sequence:
+            writer.write(int(code[1][s], 2), len(code[1][s]))
+        n_bits = writer.bit_count
+        data = writer.flush()
+
+        reader = BitReader(data)
+        decoded_code = build_canonical_code(read_code_lengths(reader))
+        self.assertEqual(decoded_code[1], code[1])
+
+        (k, max_len, primary) = build_decode_table(decoded_code)
+        result = []
+        while reader.position < n_bits:
+            (s, l, sub) = primary[reader.peek(k)]
+            result.append(s)
+            reader.skip(l)
+        self.assertEqual(sequence, result)
+
+    def test_large_alphabet(self):
+        random.seed(0)
+        alphabet_size = 70000
+
+        # every symbol appears at least once, on top of a skewed distribution
+        sequence = list(range(alphabet_size))
+        for _ in range(30000):
+            sequence.append(int(random.betavariate(1, 20) * alphabet_size))
+        random.shuffle(sequence)
+
+        f = build_frequency(sequence)
+        code = build_huffman_code(f)
+        self.assertEqual(len(code[1]), alphabet_size)
+        self.assertEqual(sequence, decode_table(build_decode_table(code, 12), encode(code, sequence)))
+
+        canonical = build_canonical_huffman_code(f, 20)
+        self.assertAlmostEqual(get_average_codelength(canonical, f), get_average_codelength(code, f), 1)
+        (data, n_bits) = encode_packed(canonical, sequence)
+        self.assertEqual(sequence, decode_packed(build_decode_table(canonical, 12), data, n_bits))
+
+        # sparse symbols get dict-backed tables
+        sparse = [s * 1000003 + 7 for s in sequence]
+        f = build_frequency(sparse)
+        code = build_huffman_code(f)
+        self.assertIsInstance(code[1], dict)
+        self.assertEqual(len(code[1]), alphabet_size)
+        self.assertEqual(sparse, decode_table(build_decode_table(code, 12), encode(code, sparse)))
+
+        lengths = build_code_lengths(f, 20)
+        self.assertIsInstance(lengths, dict)
+        writer = BitWriter()
+        write_code_lengths(writer, lengths)
+        self.assertEqual(read_code_lengths(BitReader(writer.flush())), lengths)
+
+        canonical = build_canonical_code(lengths)
+        (data, n_bits) = encode_packed(canonical, sparse)
+        self.assertEqual(sparse, decode_packed(build_decode_table(canonical, 12), data, n_bits))
+
+        words = ['w{}'.format(s) for s in sequence[:5000]]
+        code = build_huffman_code(build_frequency(words))
+        self.assertEqual(words, decode(code, encode(code, words)))
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_encode_array(self):
+        random.seed(0)
+        sequence = [int(random.betavariate(1, 5) * 50) for _ in range(10000)]
+
+        code = build_huffman_code(build_frequency(sequence))
+        for dtype in [np.uint8, np.int32, np.int64]:
+            self.assertEqual(encode_array(code, np.array(sequence, dtype = dtype)), encode_packed(code, sequence))
+        self.assertEqual(encode_array(code, np.array(sequence).reshape(100, 100)), encode_packed(code, sequence))
+        self.assertEqual(encode_array(code, sequence[:1]), encode_packed(code, sequence[:1]))
+        self.assertEqual(encode_array(code, []), (bytearray(), 0))
+        self.assertEqual(encode_array(code, sequence, 7), encode_packed(code, sequence))
+
+        # long codes straddle word boundaries
+        freq = [(i, 1 << i) for i in range(40)]
+        code = build_huffman_code(freq)
+        long_sequence = [random.randrange(40) for _ in range(1000)]
+        (data, n_bits) = encode_array(code, long_sequence)
+        self.assertEqual((data, n_bits), encode_packed(code, long_sequence))
+        self.assertEqual(long_sequence, decode_packed(build_decode_table(code), data, n_bits))
+
+        code = build_huffman_code(build_frequency([s * 1000003 for s in sequence]))
+        sparse = np.array(sequence, dtype = np.int64) * 1000003
+        self.assertEqual(encode_array(code, sparse), encode_packed(code, sparse.tolist()))
+
+        self.assertRaises(ValueError, encode_array, code, [1])
+        self.assertRaises(ValueError, encode_array, build_huffman_code([(0, 1), (1, 1)]), [0, 2])
@@ -1,4 +1,207 @@
-def encode(sequence, S):
+import functools
+import time
+
+# length of the common prefix of sequence[a:] and sequence[b:], at most limit,
+# given that the first n symbols are known to match. long matches are compared
+# in slices of growing size and narrowed down with a binary search
+def match_length(sequence, a, b, limit, n = 0):
+    step = 8
+    while n + step <= limit and sequence[a + n:a + n + step] == sequence[b + n:b + n + step]:
+        n = n + step
+        step = step * 2
+
+    while step > 8:
+        step = step // 2
+        if n + step <= limit and sequence[a + n:a + n + step] == sequence[b + n:b + n + step]:
+            n = n + step
+
+    while n < limit and sequence[a + n] == sequence[b + n]:
+        n = n + 1
+    return n
+
+# deterministic multiplicative hash of the n symbols at i, symbols are ints (bytes, bytearray,
+# memoryview) or characters. the built-in hash() is salted per process, which would make the
+# output differ between runs, and refuses bytearray or writable memoryview slices
+def hash_symbols(sequence, i, n, hash_bits):
+    h = 0
+    for x in sequence[i:i + n]:
+        h = h * 0x10001 + (x if type(x) is int else ord(x))
+    return ((h * 0x9e3779b1) & 0xffffffff) >> (32 - hash_bits)
+
+# the finder remembers the last S inserted positions in a chain, the head
+# table is indexed by a hash of the next min_len symbols. find walks the chain
+# from the most recent position, at most max_chain steps, and stops early once
+# a match of good_len is found. head and prev hold stream positions, base plus
+# the index into sequence, so slide only moves base and never rewrites the
+# tables, positions that left the window fail the window checks
+class HashChainMatchFinder:
+    def __init__(self, sequence, S, max_chain = 128, good_len = 128, min_len = 3, hash_bits = 16, size = None):
+        self.sequence = sequence
+        self.S = S
+        self.max_chain = max_chain
+        self.good_len = good_len
+        self.min_len = min_len
+        self.hash_bits = hash_bits
+        self.head = [-1] * (1 << hash_bits)
+        self.prev = [-1] * (size or max(1, min(S, len(sequence))))
+        self.base = 0
+        self.next = 0
+        self.work = 0
+
+    # drops the first n positions, sequence is the remaining data
+    def slide(self, n, sequence):
+        self.sequence = sequence
+        self.base += n
+        self.next = max(0, self.next - n)
+
+    def insert(self, i):
+        if i < self.next:
+            return
+        self.next = i + 1
+        if i + self.min_len > len(self.sequence):
+            return
+        h = hash_symbols(self.sequence, i, self.min_len, self.hash_bits)
+        self.prev[(i + self.base) % len(self.prev)] = self.head[h]
+        self.head[h] = i + self.base
+
+    def find(self, i):
+        sequence = self.sequence
+        prev = self.prev
+        base = self.base
+        max_len = len(sequence) - 1 - i
+        limit = max(0, i - self.S)
+
+        best_len = 0
+        best_start = 0
+        if max_len < self.min_len:
+            return (best_len, best_start)
+
+        j = self.head[hash_symbols(sequence, i, self.min_len, self.hash_bits)] - base
+        chain = self.max_chain
+        while j >= limit and chain > 0:
+            if sequence[j + best_len] == sequence[i + best_len]:
+                match_len = match_length(sequence, j, i, max_len)
+                if match_len > best_len:
+                    best_len = match_len
+                    best_start = j
+                    if match_len >= self.good_len or match_len == max_len:
+                        break
+            j = prev[(j + base) % len(prev)] - base
+            chain = chain - 1
+
+        self.work += self.max_chain - chain
+        if best_len < self.min_len:
+            return (0, 0)
+        return (best_len, best_start)
+
+# every hash bucket roots a binary search tree of the suffixes starting at the
+# last S positions, ordered lexicographically. inserting a position walks down
+# from the root, splits the tree around the new suffix (which becomes the root)
+# and records the longest match seen on the way. the shorter of the prefixes
+# shared with the left and right bounds is known to match, so comparisons
+# start there. the walk stops after max_depth nodes or once a match of
+# good_len is found, which bounds the work on inputs like 'a' * N. like the
+# hash chain, head and son hold stream positions (base plus index)
+class BinaryTreeMatchFinder:
+    def __init__(self, sequence, S, max_depth = 32, good_len = 128, min_len = 3, hash_bits = 16, size = None):
+        self.sequence = sequence
+        self.max_depth = max_depth
+        self.good_len = good_len
+        self.min_len = min_len
+        self.hash_bits = hash_bits
+        self.head = [-1] * (1 << hash_bits)
+        self.size = size or max(1, min(S + 1, len(sequence)))
+        self.son = [-1] * (2 * self.size)
+        self.base = 0
+        self.next = 0
+        self.work = 0
+
+    # drops the first n positions, sequence is the remaining data
+    def slide(self, n, sequence):
+        self.sequence = sequence
+        self.base += n
+        self.next = max(0, self.next - n)
+
+    def insert(self, i):
+        if i >= self.next:
+            self.update(i)
+
+    def find(self, i):
+        sequence = self.sequence
+        max_len = len(sequence) - 1 - i
+        (best_len, best_start) = self.update(i)
+
+        if best_len == self.good_len:
+            best_len = match_length(sequence, best_start, i, max_len, best_len)
+        if best_len < self.min_len:
+            return (0, 0)
+        return (best_len, best_start)
+
+    def update(self, i):
+        sequence = self.sequence
+        son = self.son
+        size = self.size
+        base = self.base
+        pos = i + base
+        self.next = i + 1
+
+        len_limit = min(self.good_len, len(sequence) - 1 - i)
+        if len_limit < self.min_len:
+            return (0, 0)
+
+        h = hash_symbols(sequence, i, self.min_len, self.hash_bits)
+        cur_match = self.head[h]
+        self.head[h] = pos
+
+        # son[ptr1] collects the subtree of smaller suffixes, son[ptr0] the larger
+        ptr1 = 2 * (pos % size)
+        ptr0 = ptr1 + 1
+        len0 = 0
+        len1 = 0
+        best_len = 0
+        best_start = 0
+        depth = self.max_depth
+
+        while True:
+            if cur_match < base or depth == 0 or pos - cur_match >= size:
+                son[ptr0] = -1
+                son[ptr1] = -1
+                break
+            depth = depth - 1
+
+            pair = 2 * (cur_match % size)
+            j = cur_match - base
+            match_len = match_length(sequence, j, i, len_limit, min(len0, len1))
+
+            # a full good_len match takes over the subtrees of cur_match. a match cut
+            # short by the end of the data is not full, the last symbol (excluded from
+            # len_limit) still orders the two suffixes and a tie puts the shorter,
+            # newer one on the smaller side
+            if match_len > best_len:
+                best_len = match_len
+                best_start = j
+                if match_len == self.good_len:
+                    son[ptr1] = son[pair]
+                    son[ptr0] = son[pair + 1]
+                    break
+
+            if sequence[j + match_len] < sequence[i + match_len]:
+                son[ptr1] = cur_match
+                ptr1 = pair + 1
+                cur_match = son[ptr1]
+                len1 = match_len
+            else:
+                son[ptr0] = cur_match
+                ptr0 = pair
+                cur_match = son[ptr0]
+                len0 = match_len
+
+        self.work += self.max_depth - depth
+        return (best_len, best_start)
+
+# match_finder is called as match_finder(sequence, S) and parse is one of
+# PARSERS, without a match finder every position of the window is tried
+def encode(sequence, S, match_finder = None, parse = 'greedy'):
     result = []
     N = len(sequence)
 
@@ -7,6 +210,12 @@ def encode(sequence, S):
 
     result.append((0, 0, sequence[0]))
 
+    if match_finder is not None:
+        finder = match_finder(sequence, S)
+        finder.insert(0)
+        PARSERS[parse](sequence, finder, result, 1, N)
+        return result
+
     i = 1
     while i < N:
         j = max(0, i - S)
@@ -31,8 +240,167 @@ def encode(sequence, S):
 
     return result
 
-def decode(opcodes):
+# parsers emit tokens for positions i up to end and return the position they
+# stopped at. matches are cut at end, so every position a token covers (and
+# inserts) is below end. positions before i must already be inserted into the
+# finder
+
+def parse_greedy(sequence, finder, result, i, end):
+    while i < end:
+        (match_len, match_start) = finder.find(i)
+        match_len = min(match_len, end - 1 - i)
+        if match_len == 0:
+            result.append((0, 0, sequence[i]))
+            finder.insert(i)
+            i = i + 1
+            continue
+
+        result.append((i - match_start, match_len, sequence[i + match_len]))
+        for j in range(i, i + match_len + 1):
+            finder.insert(j)
+        i = i + match_len + 1
+
+    return i
+
+# a match shorter than the finder's good_len is only taken if the match at the
+# next position is not longer, otherwise a literal is emitted and the next
+# match is considered in turn
+def parse_lazy(sequence, finder, result, i, end):
+    match = None
+    while i < end:
+        if match is None:
+            match = finder.find(i)
+        (match_len, match_start) = match
+        match_len = min(match_len, end - 1 - i)
+        match = None
+        finder.insert(i)
+
+        if 0 < match_len < finder.good_len and i + 1 < end:
+            next_match = finder.find(i + 1)
+            if min(next_match[0], end - 2 - i) > match_len:
+                result.append((0, 0, sequence[i]))
+                i = i + 1
+                match = next_match
+                continue
+
+        if match_len == 0:
+            result.append((0, 0, sequence[i]))
+            i = i + 1
+            continue
+
+        result.append((i - match_start, match_len, sequence[i + match_len]))
+        for j in range(i + 1, i + match_len + 1):
+            finder.insert(j)
+        i = i + match_len + 1
+
+    return i
+
+# estimated size in bits of a token with elias-gamma coded offset and length and
+# a raw symbol byte, a literal costs 10 bits
+def token_price(offset, length):
+    return 2 * (offset + 1).bit_length() + 2 * (length + 1).bit_length() + 6
+
+# shortest path over positions i..end priced with token_price. from every
+# position the longest match and all of its prefixes are tried, a match of at
+# least good_len is taken without looking at the positions it covers
+def parse_optimal(sequence, finder, result, i, end):
+    n = end - i
+    inf = float('inf')
+    cost = [0] + [inf] * n
+    back_len = [0] * (n + 1)
+    back_offset = [0] * (n + 1)
+    skip = 0
+
+    for k in range(n):
+        p = i + k
+        if k < skip:
+            finder.insert(p)
+            continue
+
+        (match_len, match_start) = finder.find(p)
+        finder.insert(p)
+
+        price = cost[k] + token_price(0, 0)
+        if price < cost[k + 1]:
+            cost[k + 1] = price
+            back_len[k + 1] = 0
+            back_offset[k + 1] = 0
+
+        match_len = min(match_len, end - 1 - p)
+        offset = p - match_start
+        lengths = range(1, match_len + 1)
+        if match_len >= finder.good_len:
+            lengths = [match_len]
+            skip = k + match_len + 1
+
+        for l in lengths:
+            price = cost[k] + token_price(offset, l)
+            if price < cost[k + l + 1]:
+                cost[k + l + 1] = price
+                back_len[k + l + 1] = l
+                back_offset[k + l + 1] = offset
+
+    tokens = []
+    k = n
+    while k > 0:
+        l = back_len[k]
+        p = i + k - l - 1
+        tokens.append((back_offset[k], l, sequence[p + l]))
+        k = k - l - 1
+    result.extend(reversed(tokens))
+
+    return end
+
+PARSERS = {'greedy': parse_greedy, 'lazy': parse_lazy, 'optimal': parse_optimal}
+CHEAPER_PARSE = {'optimal': 'lazy', 'lazy': 'greedy'}
+
+# level: (window size, match finder, parse)
+LEVELS = {
+    1: (1 << 15, functools.partial(HashChainMatchFinder, max_chain = 4, good_len = 8), 'greedy'),
+    2: (1 << 15, functools.partial(HashChainMatchFinder, max_chain = 8, good_len = 16), 'greedy'),
+    3: (1 << 16, functools.partial(HashChainMatchFinder, max_chain = 16, good_len = 32), 'greedy'),
+    4: (1 << 16, functools.partial(HashChainMatchFinder, max_chain = 16, good_len = 16), 'lazy'),
+    5: (1 << 17, functools.partial(HashChainMatchFinder, max_chain = 32, good_len = 32), 'lazy'),
+    6: (1 << 18, functools.partial(HashChainMatchFinder, max_chain = 128, good_len = 128), 'lazy'),
+    7: (1 << 20, functools.partial(BinaryTreeMatchFinder, max_depth = 24, good_len = 64), 'optimal'),
+    8: (1 << 22, functools.partial(BinaryTreeMatchFinder, max_depth = 48, good_len = 128), 'optimal'),
+    9: (1 << 24, functools.partial(BinaryTreeMatchFinder, max_depth = 96, good_len = 273), 'optimal'),
+}
+
+# the input is parsed in blocks of block_size positions, once a block takes
+# longer than time_budget seconds or more than work_budget match finder steps
+# the following blocks fall back to the next cheaper parse. the parse used for
+# every block is appended to trace
+def encode_level(sequence, level = 6, time_budget = None, work_budget = None, block_size = 1 << 16, trace = None):
+    (S, match_finder, parse) = LEVELS[level]
     result = []
+    N = len(sequence)
+
+    if N == 0:
+        return result
+
+    result.append((0, 0, sequence[0]))
+    finder = match_finder(sequence, S)
+    finder.insert(0)
+
+    i = 1
+    while i < N:
+        start_time = time.perf_counter()
+        start_work = finder.work
+        if trace is not None:
+            trace.append(parse)
+
+        i = PARSERS[parse](sequence, finder, result, i, min(N, i + block_size))
+
+        over_time = time_budget is not None and time.perf_counter() - start_time > time_budget
+        over_work = work_budget is not None and finder.work - start_work > work_budget
+        if (over_time or over_work) and parse in CHEAPER_PARSE:
+            parse = CHEAPER_PARSE[parse]
+
+    return result
+
+def decode(opcodes, history = ''):
+    result = list(history)
 
     for (o, l, c) in opcodes:
         if o == 0:
@@ -48,10 +416,144 @@ def decode(opcodes):
 
     return ''.join(result)
 
+# writes the decoded bytes into the writable buffer out from position n on and
+# returns their count, back references may reach into out[:n].
+# symbols may be ints, as produced by encoding bytes, or length 1 strings.
+# back references are copied as slices, overlapping ones (offset < length)
+# copy the period and then keep doubling the copied run. all writes are checked
+# to fit up front, so slices of a bytearray never resize it
+def decode_into(opcodes, out, n = 0):
+    if not isinstance(out, bytearray):
+        out = memoryview(out).cast('B')
+    if sum(l + 1 for (o, l, c) in opcodes) > len(out) - n:
+        raise ValueError('output buffer is too small')
+
+    first = n
+    for (o, l, c) in opcodes:
+        if o != 0:
+            start = n - o
+            if o >= l:
+                out[n:n + l] = out[start:start + l]
+            else:
+                k = 0
+                while k < l:
+                    m = min(l - k, o + k)
+                    out[n + k:n + k + m] = out[start:start + m]
+                    k = k + m
+            n = n + l
+        out[n] = c if type(c) is int else ord(c)
+        n = n + 1
+
+    return n - first
+
+def decode_bytes(opcodes):
+    out = bytearray(sum(l + 1 for (o, l, c) in opcodes))
+    decode_into(opcodes, out)
+    return out
+
+# encodes a stream fed in chunks of str or bytes. the buffer holds at most S
+# already encoded positions (the window), the positions still to be encoded
+# and fed data not yet merged into it, so memory does not depend on the total
+# input length. positions are only encoded, and matches only run, while at
+# least lookahead symbols follow them, so before flush every position inserted
+# into the finder has lookahead symbols buffered after it. the binary tree
+# orders a position by the good_len symbols after it, so its good_len has to
+# stay below lookahead. small chunks are collected until there are at least
+# lookahead symbols, the window is moved by at least S positions at a time
+class StreamEncoder:
+    def __init__(self, S, match_finder = HashChainMatchFinder, parse = 'greedy', lookahead = 258):
+        self.S = S
+        self.match_finder = match_finder
+        self.parse = parse
+        self.lookahead = lookahead
+        self.buffer = None
+        self.pending = []
+        self.pending_len = 0
+        self.finder = match_finder('', S, size = S + 1)
+        self.i = 0
+
+        if isinstance(self.finder, BinaryTreeMatchFinder) and lookahead <= self.finder.good_len:
+            raise ValueError('lookahead {} must exceed the good_len {} of the binary tree'.format(lookahead, self.finder.good_len))
+
+    def feed(self, chunk):
+        self.pending.append(chunk)
+        self.pending_len += len(chunk)
+        if self.pending_len < self.lookahead:
+            return []
+        return self.encode(len(self.buffer or '') + self.pending_len - self.lookahead)
+
+    def flush(self):
+        return self.encode(len(self.buffer or '') + self.pending_len)
+
+    def encode(self, end):
+        result = []
+        if self.pending_len:
+            if self.buffer is None:
+                self.buffer = '' if isinstance(self.pending[0], str) else bytes()
+            self.buffer = self.buffer + self.buffer[:0].join(self.pending)
+            self.pending = []
+            self.pending_len = 0
+
+        if self.buffer is None or self.i >= end:
+            return result
+
+        self.finder.sequence = self.buffer
+        if self.i == 0:
+            result.append((0, 0, self.buffer[0]))
+            self.finder.insert(0)
+            self.i = 1
+
+        self.i = PARSERS[self.parse](self.buffer, self.finder, result, self.i, end)
+
+        if self.i >= 2 * self.S:
+            n = self.i - self.S
+            self.buffer = self.buffer[n:]
+            self.finder.slide(n, self.buffer)
+            self.i = self.i - n
+
+        return result
+
+# decodes tokens fed in batches and returns the newly decoded part of the
+# stream (None while nothing was decoded yet, as the symbol type is unknown),
+# only the last S symbols are kept to resolve back references
+class StreamDecoder:
+    def __init__(self, S):
+        self.S = S
+        self.history = None
+
+    def feed(self, opcodes):
+        if not opcodes:
+            return self.history[:0] if self.history is not None else None
+
+        if self.history is None:
+            self.history = bytes() if type(opcodes[0][2]) is int else ''
+
+        if isinstance(self.history, str):
+            result = decode(opcodes, self.history)[len(self.history):]
+        else:
+            out = bytearray(len(self.history) + sum(l + 1 for (o, l, c) in opcodes))
+            out[:len(self.history)] = self.history
+            decode_into(opcodes, out, len(self.history))
+            result = bytes(out[len(self.history):])
+
+        self.history = (self.history + result)[-self.S:]
+        return result
+
 import unittest
 import random
+import os
+import subprocess
+import sys
 
 class Lz77TestCase(unittest.TestCase):
+    # text fixtures most tests share
+    lorem = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo'
+
+    # skewed random letters, the same for a given n
+    def _random_text(self, n):
+        random.seed(0)
+        return ''.join(chr(ord('a') + int(random.betavariate(1, 5) * 26)) for _ in range(n))
+
     def test_book(self):
         t = 'cabracadabrar'
         self.assertEqual(t, decode(encode(t, 6)))
@@ -77,18 +579,254 @@ class Lz77TestCase(unittest.TestCase):
             self.assertEqual(t1, decode(encode(t1, 15)))
 
     def test_random(self):
-        alphabet_size = 26
-        random.seed(0)
-
-        sequence = []
-        for _ in range(1000):
-            sequence.append(chr(ord('a') + int(random.betavariate(1, 5) * alphabet_size)))
-        sequence = ''.join(sequence)
-
+        sequence = self._random_text(1000)
         self.assertEqual(sequence, decode(encode(sequence, 16)))
 
     def test_text(self):
-        sequence = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo'
-        self.assertEqual(sequence, decode(encode(sequence, 1000)))
+        self.assertEqual(self.lorem, decode(encode(self.lorem, 1000)))
+
+    def _test_finder(self, match_finder, sequence, S):
+        e = encode(sequence, S, match_finder)
+        self.assertEqual(sequence, decode(e))
+        for (o, l, c) in e:
+            self.assertLessEqual(o, S)
+        return e
+
+    # runs every finder over the same inputs
+    def _test_finders(self, finders):
+        sequence = self._random_text(1000)
+        lorem = self.lorem
 
+        for f in finders:
+            self._test_finder(f, 'cabracadabrar', 6)
+            t = 'abcdefghi' * 3
+            self._test_finder(f, t, 8)
+            self.assertLess(len(self._test_finder(f, t, 9)), len(t))
+
+            t = 'a'
+            t1 = 'a'
+            for _ in range(100):
+                t += 'a'
+                t1 += ['a', 'b'][t1[-1] == 'a']
+                for S in [1, 4, 15]:
+                    self._test_finder(f, t, S)
+                    self._test_finder(f, t1, S)
+
+            self._test_finder(f, sequence, 16)
+            self._test_finder(f, sequence, 1000)
+            self._test_finder(f, lorem, 1000)
+            self._test_finder(f, lorem * 20, 1 << 20)
+        return (sequence, lorem)
+
+    def test_hash_chain(self):
+        self._test_finders([
+            HashChainMatchFinder,
+            functools.partial(HashChainMatchFinder, max_chain = 1),
+            functools.partial(HashChainMatchFinder, good_len = 4, min_len = 1),
+            functools.partial(HashChainMatchFinder, min_len = 4, hash_bits = 2)])
+
+        self.assertEqual(encode('a' * 1000, 10, HashChainMatchFinder), [(0, 0, 'a'), (1, 998, 'a')])
+
+    def test_binary_tree(self):
+        (sequence, lorem) = self._test_finders([
+            BinaryTreeMatchFinder,
+            functools.partial(BinaryTreeMatchFinder, max_depth = 1),
+            functools.partial(BinaryTreeMatchFinder, good_len = 4, min_len = 1),
+            functools.partial(BinaryTreeMatchFinder, min_len = 4, hash_bits = 2)])
+
+        self.assertEqual(encode('a' * 20000, 1 << 20, BinaryTreeMatchFinder), [(0, 0, 'a'), (1, 19998, 'a')])
+
+        # with an unlimited depth the tree finds the longest match in the window
+        finder = functools.partial(BinaryTreeMatchFinder, max_depth = 1 << 30, good_len = 1 << 30, min_len = 1)
+        for (s, S) in [(sequence, 16), (sequence, 1000), (lorem, 1000)]:
+            self.assertEqual(
+                [l for (o, l, c) in self._test_finder(finder, s, S)],
+                [l for (o, l, c) in encode(s, S)])
+
+        # matches running into the end of the data keep the tree ordered, every
+        # later position still sees its longest match
+        for t in ['ab' * 20, 'a' * 30 + 'b', 'abaababaab' * 3, sequence[:200]]:
+            f = finder(t, len(t))
+            f.insert(0)
+            for i in range(1, len(t)):
+                expected = 0
+                for j in range(i):
+                    expected = max(expected, match_length(t, j, i, len(t) - 1 - i))
+                self.assertEqual(f.find(i)[0], expected)
+
+    def test_match_length(self):
+        s = 'abcd' * 100 + 'x' + 'abcd' * 10
+        for limit in [0, 1, 7, 8, 9, 63, 64, 65, 396, 1000]:
+            for b in [4, 8, 396, 401]:
+                expected = 0
+                while expected < limit and b + expected < len(s) and s[expected] == s[b + expected]:
+                    expected = expected + 1
+                self.assertEqual(match_length(s, 0, b, min(limit, len(s) - b)), expected)
+        self.assertEqual(match_length(s, 0, 4, 100, 50), 100)
+
+    def test_parse(self):
+        sequence = self._random_text(1000)
+        lorem = self.lorem
+
+        def price(e):
+            return sum(token_price(o, l) for (o, l, c) in e)
+
+        finders = [
+            functools.partial(HashChainMatchFinder, good_len = 1 << 30, min_len = 1),
+            functools.partial(BinaryTreeMatchFinder, good_len = 1 << 30, min_len = 1),
+            functools.partial(HashChainMatchFinder, good_len = 8),
+            functools.partial(BinaryTreeMatchFinder, good_len = 8)]
+
+        for (t, S) in [('cabracadabrar', 6), ('abcdefghi' * 3, 9), ('a' * 100, 4), (sequence, 16), (sequence, 1000), (lorem * 3, 1000)]:
+            for f in finders:
+                greedy = self._test_finder(f, t, S)
+                lazy = encode(t, S, f, 'lazy')
+                optimal = encode(t, S, f, 'optimal')
+                self.assertEqual(t, decode(lazy))
+                self.assertEqual(t, decode(optimal))
+                for (o, l, c) in lazy + optimal:
+                    self.assertLessEqual(o, S)
+                if f.keywords['good_len'] > len(t):
+                    self.assertLessEqual(price(optimal), price(greedy))
+                    self.assertLessEqual(price(optimal), price(lazy))
+
+    def test_levels(self):
+        sequence = self._random_text(1000)
+        lorem = self.lorem
+
+        for level in LEVELS:
+            for t in ['', 'a', 'cabracadabrar', 'a' * 1000, sequence, lorem * 5]:
+                self.assertEqual(t, decode(encode_level(t, level)))
+                self.assertEqual(t, decode(encode_level(t, level, block_size = 7)))
+
+        trace = []
+        e = encode_level(sequence, 9, work_budget = 0, block_size = 100, trace = trace)
+        self.assertEqual(sequence, decode(e))
+        self.assertEqual(trace[:3], ['optimal', 'lazy', 'greedy'])
+        self.assertEqual(set(trace[3:]), {'greedy'})
+
+        trace = []
+        e = encode_level(lorem * 5, 9, time_budget = 60, block_size = 100, trace = trace)
+        self.assertEqual(lorem * 5, decode(e))
+        self.assertEqual(set(trace), {'optimal'})
+
+    def test_decode_bytes(self):
+        lorem = self.lorem.encode()
+        sequence = self._random_text(1000).encode()
+
+        for t in [b'', b'a', b'cabracadabrar', b'a' * 1000, b'abc' * 100, sequence, lorem * 5]:
+            for S in [1, 4, 16, 1000]:
+                self.assertEqual(decode_bytes(encode(t, S, HashChainMatchFinder)), t)
+                self.assertEqual(decode_bytes(encode(memoryview(t), S, BinaryTreeMatchFinder)), t)
+            self.assertEqual(decode_bytes(encode_level(t, 7)), t)
+
+        self.assertEqual(decode_bytes(encode('cabracadabrar', 6)), b'cabracadabrar')
+        self.assertEqual(decode_bytes([(0, 0, 97), (1, 6, 98), (2, 5, 99), (5, 5, b'd')]), b'a' * 7 + b'b' + b'ab' * 2 + b'a' + b'c' + b'babac' + b'd')
+
+        e = encode(lorem, 100, HashChainMatchFinder)
+        buffer = bytearray(len(lorem) + 20)
+        self.assertEqual(decode_into(e, memoryview(buffer)[10:]), len(lorem))
+        self.assertEqual(buffer, bytes(10) + lorem + bytes(10))
+        self.assertRaises(ValueError, decode_into, e, bytearray(len(lorem) - 1))
+
+    def test_hash(self):
+        self.assertEqual(hash_symbols('abc', 0, 3, 16), hash_symbols(b'abc', 0, 3, 16))
+        self.assertEqual(hash_symbols('xabc', 1, 3, 16), hash_symbols(bytearray(b'abc'), 0, 3, 16))
+        self.assertLess(hash_symbols('abc', 0, 3, 2), 4)
+
+        sequence = self._random_text(3000).encode()
+        for level in [6, 9]:
+            e = [(o, l) for (o, l, c) in encode_level(sequence, level)]
+            for t in [bytearray(sequence), memoryview(bytearray(sequence)), sequence.decode()]:
+                self.assertEqual([(o, l) for (o, l, c) in encode_level(t, level)], e)
+
+        # the same tokens whatever the interpreter's hash seed
+        script = 'import lz77; print(lz77.encode_level(' + repr(sequence) + ', 6))'
+        outputs = set()
+        for seed in ['1', '2', '3']:
+            env = dict(os.environ, PYTHONHASHSEED = seed)
+            outputs.add(subprocess.run([sys.executable, '-c', script], env = env, capture_output = True, text = True,
+                cwd = os.path.dirname(os.path.abspath(__file__))).stdout)
+        self.assertEqual(len(outputs), 1)
+
+    def test_stream(self):
+        lorem = self.lorem
+        sequence = self._random_text(3000)
+
+        for t in ['', 'a', 'cabracadabrar', 'a' * 1000, sequence, lorem * 10, (lorem * 10).encode(), memoryview(sequence.encode())]:
+            for S in [1, 16, 100, 5000]:
+                for (match_finder, parse, lookahead) in [
+                        (HashChainMatchFinder, 'greedy', 20),
+                        (BinaryTreeMatchFinder, 'lazy', 258),
+                        (functools.partial(BinaryTreeMatchFinder, good_len = 16), 'greedy', 20),
+                        (functools.partial(BinaryTreeMatchFinder, good_len = 63), 'optimal', 64),
+                        (HashChainMatchFinder, 'optimal', 20)]:
+                    encoder = StreamEncoder(S, match_finder, parse, lookahead = lookahead)
+                    decoder = StreamDecoder(S)
+                    tokens = []
+                    decoded = '' if isinstance(t, str) else bytes()
+
+                    i = 0
+                    while i < len(t):
+                        n = random.choice([0, 1, 7, 50, 300])
+                        chunk = encoder.feed(t[i:i + n])
+                        if chunk:
+                            decoded += decoder.feed(chunk)
+                        tokens += chunk
+                        i = i + n
+                    chunk = encoder.flush()
+                    if chunk:
+                        decoded += decoder.feed(chunk)
+                    tokens += chunk
+
+                    self.assertEqual(decoded, t)
+                    self.assertEqual(decode(tokens) if isinstance(t, str) else decode_bytes(tokens), t)
+                    if len(t) > 0:
+                        self.assertEqual(len(decoder.history), min(S, len(t)))
+                    for (o, l, c) in tokens:
+                        self.assertLessEqual(o, S)
+
+        # matches stop at the lookahead, so before flush every inserted position has
+        # more than good_len symbols buffered after it
+        short = []
+        class RecordingFinder(BinaryTreeMatchFinder):
+            def update(self, i):
+                short.append(len(self.sequence) - 1 - i < self.good_len)
+                return BinaryTreeMatchFinder.update(self, i)
+
+        t = 'abcabcabd' * 300
+        for parse in ['greedy', 'lazy', 'optimal']:
+            del short[:]
+            encoder = StreamEncoder(16, functools.partial(RecordingFinder, good_len = 16), parse, lookahead = 20)
+            head = encoder.finder.head
+            tokens = []
+            for i in range(0, len(t), 50):
+                tokens += encoder.feed(t[i:i + 50])
+            self.assertEqual(short.count(True), 0)
+            tokens += encoder.flush()
+            self.assertEqual(decode(tokens), t)
+            # sliding moves the base, the tables are not rebuilt
+            self.assertGreater(encoder.finder.base, 0)
+            self.assertIs(encoder.finder.head, head)
+
+        self.assertRaises(ValueError, StreamEncoder, 16, BinaryTreeMatchFinder, lookahead = 128)
+        self.assertRaises(ValueError, StreamEncoder, 16, functools.partial(BinaryTreeMatchFinder, good_len = 20), lookahead = 20)
+
+    def test_stream_memory(self):
+        S = 1000
+        encoder = StreamEncoder(S)
+        decoder = StreamDecoder(S)
+        random.seed(0)
+        words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
 
+        t = ''
+        decoded = ''
+        for _ in range(200):
+            chunk = ' '.join(random.choice(words) for _ in range(100))
+            t += chunk
+            decoded += decoder.feed(encoder.feed(chunk))
+            self.assertLessEqual(len(encoder.buffer), 2 * S + encoder.lookahead + len(chunk))
+            self.assertLessEqual(len(encoder.finder.prev), S + 1)
+            self.assertLessEqual(len(decoder.history), S)
+        decoded += decoder.feed(encoder.flush())
+        self.assertEqual(decoded, t)
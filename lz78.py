@@ -1,49 +1,353 @@
-def encode(sequence):
-    d = dict()
+from array import array
+import heapq
+from utils import BitWriter, BitReader
+
+RATIO_INTERVAL = 1 << 10
+RATIO_DROP = 0.9
+
+# decides where the phrase added after every token goes, the encoder and the
+# decoder make the same calls so their dictionaries stay in lockstep. once
+# max_size phrases exist the policy applies:
+#   freeze  - no more phrases are added
+#   reset   - the dictionary is cleared
+#   monitor - like freeze, but the dictionary is cleared when the symbols per
+#             token over the last RATIO_INTERVAL tokens fall below RATIO_DROP
+#             of the best seen since the last reset
+#   lru     - the least recently used leaf phrase is replaced, a phrase is used
+#             when a token refers to it
+class PhraseLimit:
+    def __init__(self, max_size = None, policy = 'freeze'):
+        if policy not in ('freeze', 'reset', 'monitor', 'lru'):
+            raise ValueError('unknown dictionary policy {}'.format(policy))
+
+        self.max_size = max_size
+        self.policy = policy
+        self.resets = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self.size = 0
+        self.parent = [0]
+        self.children = [0]
+        self.last_use = [0]
+        self.heap = []
+        self.time = 0
+        self.tokens = 0
+        self.symbols = 0
+        self.best_ratio = 0
+
+    # called for every token with the phrase it refers to and the number of
+    # symbols it decodes to. returns the index of the new phrase, which may be
+    # a reused one, 0 if no phrase is added and -1 if the dictionary was cleared
+    def add(self, index, length):
+        full = self.max_size is not None and self.size >= self.max_size
+
+        if self.policy == 'monitor':
+            self.tokens += 1
+            self.symbols += length
+            if self.tokens == RATIO_INTERVAL:
+                ratio = self.symbols / self.tokens
+                dropped = full and ratio < self.best_ratio * RATIO_DROP
+                self.best_ratio = max(self.best_ratio, ratio)
+                self.tokens = 0
+                self.symbols = 0
+                if dropped:
+                    self.clear()
+                    self.resets += 1
+                    return -1
+
+        if self.policy == 'lru' and index != 0:
+            self.time += 1
+            self.last_use[index] = self.time
+            if self.children[index] == 0:
+                heapq.heappush(self.heap, (self.time, index))
+
+        if not full:
+            self.size += 1
+            self.parent.append(index)
+            self.children.append(0)
+            self.last_use.append(self.time)
+            self.children[index] += 1
+            if self.policy == 'lru':
+                heapq.heappush(self.heap, (self.time, self.size))
+            return self.size
+
+        if self.policy == 'reset':
+            self.clear()
+            self.resets += 1
+            return -1
+
+        if self.policy == 'lru':
+            return self.evict(index)
+
+        return 0
+
+    def evict(self, index):
+        heap = self.heap
+        if len(heap) > 2 * self.max_size + 16:
+            heap[:] = [(self.last_use[q], q) for q in range(1, self.size + 1) if self.children[q] == 0]
+            heapq.heapify(heap)
+
+        # entries are stale once the phrase got children or was used again,
+        # the parent of the new phrase must stay
+        held = None
+        q = 0
+        while heap:
+            (t, k) = heapq.heappop(heap)
+            if self.children[k] or self.last_use[k] != t:
+                continue
+            if k == index:
+                held = (t, k)
+                continue
+            q = k
+            break
+
+        if held:
+            heapq.heappush(heap, held)
+        if q == 0:
+            return 0
+
+        p = self.parent[q]
+        self.children[p] -= 1
+        if p != 0 and self.children[p] == 0:
+            heapq.heappush(heap, (self.last_use[p], p))
+
+        self.parent[q] = index
+        self.children[index] += 1
+        self.last_use[q] = self.time
+        heapq.heappush(heap, (self.time, q))
+        self.evictions += 1
+        return q
+
+# the dictionary is a trie, trie[k] maps a symbol to the index of the phrase
+# that extends phrase k by it (0 is the empty phrase), so extending a match
+# costs one lookup per symbol. max_size and policy bound the dictionary, see
+# PhraseLimit
+def encode(sequence, max_size = None, policy = 'freeze'):
+    limit = PhraseLimit(max_size, policy)
+    trie = [dict()]
+    parent = [0]
+    symbols = [None]
     result = []
+    N = len(sequence)
+
+    def add_phrase(node, symbol, length):
+        k = limit.add(node, length)
+        if k < 0:
+            trie[:] = [dict()]
+            del parent[1:]
+            del symbols[1:]
+        elif k == len(trie):
+            trie.append(dict())
+            parent.append(node)
+            symbols.append(symbol)
+        elif k > 0:
+            del trie[parent[k]][symbols[k]]
+            parent[k] = node
+            symbols[k] = symbol
+        if k > 0:
+            trie[node][symbol] = k
 
     i = 0
 
-    while i < len(sequence):
-        if i + 1 == len(sequence):
+    while i < N:
+        if i + 1 == N:
             result.append((0, sequence[i]))
             break
 
-        if sequence[i] not in d:
+        node = trie[0].get(sequence[i])
+        if node is None:
             result.append((0, sequence[i]))
-            d[sequence[i]] = len(d) + 1
+            add_phrase(0, sequence[i], 1)
             i = i + 1
             continue
 
         j = i + 1
-        while j + 1 < len(sequence) and sequence[i:j + 1] in d:
+        while j + 1 < N:
+            child = trie[node].get(sequence[j])
+            if child is None:
+                break
+            node = child
             j = j + 1
 
-        result.append((d[sequence[i:j]], sequence[j]))
+        result.append((node, sequence[j]))
 
-        if j + 1 < len(sequence) and sequence[i:j + 1] not in d:
-            d[sequence[i:j+1]] = len(d) + 1
+        if j + 1 < N:
+            add_phrase(node, sequence[j], j - i + 1)
 
         i = j + 1
 
     return result
 
-def decode(e):
-    d = dict()
-    result = []
+# every token adds a phrase, stored as its parent phrase, last symbol and
+# length. a first pass makes the PhraseLimit calls on the lengths alone, which
+# sizes the output and records where every token's phrase went. the second
+# writes each phrase back to front into the preallocated output by following
+# the parents, so the table is O(number of phrases). str symbols are joined
+# into a string, any other symbols (list items, the ints of bytes) come back
+# as a list
+def decode(e, max_size = None, policy = 'freeze'):
+    limit = PhraseLimit(max_size, policy)
+    length = array('I', [0])
+    slots = array('i')
+    total = 0
 
     for (index, symbol) in e:
-        if index == 0:
-            result.append(symbol)
-            d[len(d) + 1] = [symbol]
-            continue
+        l = length[index] + 1
+        total += l
+        k = limit.add(index, l)
+        slots.append(k)
+        if k < 0:
+            del length[1:]
+        elif k == len(length):
+            length.append(l)
+        elif k > 0:
+            length[k] = l
 
-        result += d[index] + [symbol]
-        d[len(d) + 1] = d[index] + [symbol]
+    parent = array('I', [0])
+    del length[1:]
+    symbols = [None]
+    result = [None] * total
+    n = 0
 
+    for ((index, symbol), k) in zip(e, slots):
+        l = length[index]
+        n = n + l + 1
+        result[n - 1] = symbol
+        i = n - 2
+        p = index
+        while p:
+            result[i] = symbols[p]
+            p = parent[p]
+            i = i - 1
+
+        if k < 0:
+            del parent[1:]
+            del length[1:]
+            del symbols[1:]
+        elif k == len(parent):
+            parent.append(index)
+            length.append(l + 1)
+            symbols.append(symbol)
+        elif k > 0:
+            parent[k] = index
+            length[k] = l + 1
+            symbols[k] = symbol
+
+    if result and not isinstance(result[0], str):
+        return result
     return ''.join(result)
 
+# lzw over bytes: codes 0..255 are the single bytes, the phrase k of a
+# PhraseLimit is code 255 + k. only codes are written, each with just enough
+# bits for the largest code the dictionary holds at that point, so the width
+# grows with the dictionary. the decoder learns a phrase one code late, the
+# encoder adds it right after writing a code, both call PhraseLimit.add before
+# the next code is written or read
+def encode_lzw(data, max_size = None, policy = 'freeze'):
+    limit = PhraseLimit(max_size, policy)
+    trie = [dict() for _ in range(256)]
+    parent = [0] * 256
+    symbols = [0] * 256
+    writer = BitWriter()
+
+    if len(data) == 0:
+        return writer.flush()
+
+    data = memoryview(data).cast('B')
+    w = data[0]
+    length = 1
+
+    for c in data[1:]:
+        child = trie[w].get(c)
+        if child is not None:
+            w = child
+            length = length + 1
+            continue
+
+        writer.write(w, (255 + limit.size).bit_length())
+        k = limit.add(w - 255 if w > 255 else 0, length)
+        if k < 0:
+            del trie[256:]
+            del parent[256:]
+            del symbols[256:]
+            for t in trie:
+                t.clear()
+        elif k > 0:
+            code = 255 + k
+            if code == len(trie):
+                trie.append(dict())
+                parent.append(w)
+                symbols.append(c)
+            else:
+                del trie[parent[code]][symbols[code]]
+                parent[code] = w
+                symbols[code] = c
+            trie[w][c] = code
+
+        w = c
+        length = 1
+
+    writer.write(w, (255 + limit.size).bit_length())
+    return writer.flush()
+
+def decode_lzw(data, max_size = None, policy = 'freeze'):
+    limit = PhraseLimit(max_size, policy)
+    parent = array('I', range(256))
+    last = array('B', range(256))
+    first = array('B', range(256))
+    length = array('I', [1] * 256)
+
+    reader = BitReader(data)
+    n_bits = len(reader.data) * 8
+    result = bytearray()
+    prev = -1
+    k = 0
+
+    while True:
+        if prev >= 0:
+            k = limit.add(prev - 255 if prev > 255 else 0, length[prev])
+            if k < 0:
+                del parent[256:]
+                del last[256:]
+                del first[256:]
+                del length[256:]
+
+        width = (255 + limit.size).bit_length()
+        if reader.position + width > n_bits:
+            break
+        code = reader.read(width)
+
+        if prev >= 0 and k > 0:
+            new_code = 255 + k
+            c = first[prev] if code == new_code else first[code]
+            if new_code == len(parent):
+                parent.append(prev)
+                last.append(c)
+                first.append(first[prev])
+                length.append(length[prev] + 1)
+            else:
+                parent[new_code] = prev
+                last[new_code] = c
+                first[new_code] = first[prev]
+                length[new_code] = length[prev] + 1
+
+        l = length[code]
+        i = len(result) + l - 1
+        result += bytes(l)
+        p = code
+        while l:
+            result[i] = last[p]
+            p = parent[p]
+            i = i - 1
+            l = l - 1
+        prev = code
+
+    return result
+
 import unittest
+import random
 
 class Lz78TestCase(unittest.TestCase):
     def test_book(self):
@@ -58,3 +362,105 @@ class Lz78TestCase(unittest.TestCase):
                 i = i >> 1
             self.assertEqual(s, decode(encode(s)))
 
+    def test_encode(self):
+        self.assertEqual(encode('wabba wabba wabba wabba woo woo woo'), [
+            (0, 'w'), (0, 'a'), (0, 'b'), (3, 'a'), (0, ' '), (1, 'a'), (3, 'b'), (2, ' '), (6, 'b'),
+            (4, ' '), (9, 'b'), (8, 'w'), (0, 'o'), (13, ' '), (1, 'o'), (14, 'w'), (13, 'o')])
+        self.assertEqual(encode('a' * 36), [(0, 'a'), (1, 'a'), (2, 'a'), (3, 'a'), (4, 'a'), (5, 'a'), (6, 'a'), (7, 'a')])
+        self.assertEqual(encode('abababbabaabbab'), [(0, 'a'), (0, 'b'), (1, 'b'), (3, 'b'), (3, 'a'), (4, 'a'), (0, 'b')])
+        self.assertEqual(encode(''), [])
+        self.assertEqual(encode([1, 2, 1, 2, 1]), [(0, 1), (0, 2), (1, 2), (0, 1)])
+
+    def test_decode(self):
+        self.assertEqual(decode([]), '')
+        self.assertEqual(decode([(0, 'a'), (1, 'b'), (2, 'c'), (0, 'd'), (3, 'a')]), 'aababcdabca')
+
+        s = 'a' * 100000 + 'b' * 1000 + 'ab' * 5000
+        self.assertEqual(s, decode(encode(s)))
+
+        self.assertEqual(decode(encode([1, 2, 1, 2, 1])), [1, 2, 1, 2, 1])
+        self.assertEqual(decode(encode(b'wabba wabba woo')), list(b'wabba wabba woo'))
+        random.seed(0)
+        s = [random.randrange(5) for _ in range(3000)]
+        for max_size in [None, 16]:
+            self.assertEqual(decode(encode(s, max_size, 'lru'), max_size, 'lru'), s)
+
+    def test_bounded(self):
+        random.seed(0)
+        text = 'wabba wabba wabba wabba woo woo woo ' * 20
+        noise = ''.join(random.choice('abcdefghij') for _ in range(3000))
+
+        for policy in ['freeze', 'reset', 'monitor', 'lru']:
+            for max_size in [1, 2, 5, 16, 100, None]:
+                for s in ['', 'a', 'a' * 1000, text, noise, text + noise + text]:
+                    self.assertEqual(s, decode(encode(s, max_size, policy), max_size, policy))
+
+                    limit = PhraseLimit(max_size, policy)
+                    for (index, symbol) in encode(s, max_size, policy):
+                        limit.add(index, 1)
+                        if max_size is not None:
+                            self.assertLessEqual(limit.size, max_size)
+
+        self.assertEqual(encode(text, 1000, 'lru'), encode(text))
+        self.assertRaises(ValueError, encode, text, 10, 'fifo')
+
+    def test_lru(self):
+        limit = PhraseLimit(3, 'lru')
+        self.assertEqual(limit.add(0, 1), 1)
+        self.assertEqual(limit.add(0, 1), 2)
+        self.assertEqual(limit.add(1, 2), 3)
+        # 2 is the least recently used leaf, 1 has a child
+        self.assertEqual(limit.add(3, 3), 2)
+        self.assertEqual(limit.evictions, 1)
+        self.assertEqual(limit.parent[2], 3)
+        # 2 was just created, 3 is the token's phrase and no longer a leaf
+        self.assertEqual(limit.add(0, 1), 2)
+        self.assertEqual(limit.parent[2], 0)
+        self.assertEqual(limit.children[3], 0)
+        # now 3 is the oldest leaf
+        self.assertEqual(limit.add(2, 2), 3)
+
+    def test_monitor(self):
+        random.seed(0)
+        first = ''.join(random.choice('ab') for _ in range(20000))
+        second = ''.join(random.choice('cdefghijklmnopqrstuvwxyz') for _ in range(100000))
+        s = first + second
+
+        frozen = encode(s, 1000, 'freeze')
+        monitored = encode(s, 1000, 'monitor')
+        self.assertEqual(s, decode(monitored, 1000, 'monitor'))
+        self.assertLess(len(monitored), len(frozen))
+
+        limit = PhraseLimit(10, 'monitor')
+        for _ in range(RATIO_INTERVAL):
+            limit.add(0, 10)
+        self.assertEqual(limit.size, 10)
+        for _ in range(RATIO_INTERVAL - 1):
+            self.assertEqual(limit.add(0, 9), 0)
+        self.assertEqual(limit.add(0, 9), 0)
+        for _ in range(RATIO_INTERVAL - 1):
+            limit.add(0, 8)
+        self.assertEqual(limit.add(0, 8), -1)
+        self.assertEqual(limit.resets, 1)
+        self.assertEqual(limit.size, 0)
+
+    def test_lzw(self):
+        random.seed(0)
+        text = b'wabba wabba wabba wabba woo woo woo ' * 20
+        noise = bytes(random.choice(b'abcdefghij') for _ in range(3000))
+        binary = bytes(random.getrandbits(8) for _ in range(3000))
+
+        for policy in ['freeze', 'reset', 'monitor', 'lru']:
+            for max_size in [1, 2, 5, 16, 300, None]:
+                for s in [b'', b'a', b'aa', b'aaa', b'a' * 1000, text, noise, binary, text + noise + text]:
+                    e = encode_lzw(s, max_size, policy)
+                    self.assertIsInstance(e, bytearray)
+                    self.assertEqual(s, decode_lzw(bytes(e), max_size, policy))
+
+        self.assertEqual(decode_lzw(memoryview(encode_lzw(memoryview(text)))), text)
+
+        # 8 bits for the first code, 9 bits once the dictionary has phrases
+        self.assertEqual(encode_lzw(b'ab'), bytes([ord('a'), ord('b') >> 1, (ord('b') & 1) << 7]))
+        self.assertEqual(len(encode_lzw(b'TOBEORNOTTOBEORTOBEORNOT')), (8 + 15 * 9 + 7) // 8)
+        self.assertLess(len(encode_lzw(b'a' * 10000)), 200)
+        self.assertLess(len(encode_lzw(text)), len(text) // 4)
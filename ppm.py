@@ -17,13 +17,13 @@ class CountArraySparse:
 
         if self.last == -1 or self.last == x:
             self.last = x
-            return
+            return self
 
         if self.last < x:
             self.prev[x] = self.last
             self.cum_counts[x] += self.cum_counts[self.last]
             self.last = x
-            return
+            return self
 
         j = self.last
         self.cum_counts[self.last] += 1
@@ -35,13 +35,14 @@ class CountArraySparse:
             i = self.prev[j]
 
         if i == x:
-            return
+            return self
 
         if i >= 0 and i < x and self.cum_counts[x] == 1: # new entry, accumulate prev
             self.cum_counts[x] += self.cum_counts[i]
 
         self.prev[j] = x
         self.prev[x] = i
+        return self
 
 
     def get_count(self, x):
@@ -57,329 +58,714 @@ class CountArraySparse:
             return 0
         return self.cum_counts[self.last]
 
-import math
+    # halves every count, rounding up so no present symbol disappears, and relinks the prev chain
+    def halve(self):
+        items = []
+        x = self.last
+        while x != -1:
+            items.append((x, (self.get_count(x) + 1) >> 1))
+            x = self.prev[x]
+
+        total = 0
+        p = -1
+        for (x, count) in reversed(items):
+            total += count
+            self.cum_counts[x] = total
+            self.prev[x] = p
+            p = x
+        return self
+
+    # (symbol, range_l, range_u) for the symbol covering cumulative count C < total,
+    # walks down the prev chain so only present symbols are visited
+    def find(self, C):
+        x = self.last
+        while x != -1:
+            p = self.prev[x]
+            range_l = self.cum_counts[p] if p != -1 else 0
+            if range_l <= C:
+                return (x, range_l, self.cum_counts[x])
+            x = p
+
+from array import array
+from collections import deque
+import bisect
+import itertools
+import mmap
+import sys
+import functools
+from artihmetic import RangeEncoder, RangeDecoder, FenwickTree, RANGE_BOTTOM
+from utils import map_chunks, pack_frame, unpack_frame
 
-def get_bit(value, index):
-    return (value >> index) & 1
+# compact count layouts with the CountArraySparse interface (find and halve included) plus items() for the
+# present (symbol, count) pairs in symbol order. increment_count and halve return the object to keep,
+# a layout that outgrows itself hands back its replacement. memory_usage is in bytes
 
-def msb(value, m):
-    return get_bit(value, m - 1)
+# one symbol seen so far (or none), which is what most high order contexts end up with
+class SingletonCounts:
+    __slots__ = ('symbol', 'count')
 
-class ArithmeticEncoder:
-    def __init__(self, m):
-        self.m = m
-        self.l = 0
-        self.u = (1 << m) - 1
-        self.scale3 = 0
-        self.mask = (1 << m) - 1
-        self.result = []
+    def __init__(self):
+        self.symbol = -1
+        self.count = 0
 
-    def encode(self, range_l, range_u, range_max):
-        l = self.l
-        u = self.u
-        scale3 = self.scale3
-        m = self.m
-        mask = self.mask
+    def contains(self, x):
+        return x in self
 
-        l1 = self.l + math.floor((u - l + 1) * range_l / range_max)
-        u1 = self.l + math.floor((u - l + 1) * range_u / range_max) - 1
+    def __contains__(self, x):
+        return x == self.symbol
 
-        l = l1
-        u = u1
+    def increment_count(self, x):
+        if self.count == 0 or x == self.symbol:
+            self.symbol = x
+            self.count += 1
+            return self
+        return SparseCounts([self.symbol], [self.count]).increment_count(x)
 
-        e3 = get_bit(l, m - 2) and not get_bit(u, m - 2)
+    def get_count(self, x):
+        return self.count
 
-        while (msb(l, m) == msb(u, m)) or e3:
-            if msb(l, m) == msb(u, m):
-                b = msb(l, m)
-                self.result.append(b)
-                l = (l << 1) & mask
-                u = ((u << 1) | 1) & mask
+    def get_cum_count(self, x):
+        return self.count
 
-                while scale3 > 0:
-                    self.result.append(b ^ 1)
-                    scale3 = scale3 - 1
-            if e3:
-                l = l + (1 << (m - 2))
-                l = (l << 1) & mask
-                u = u + (1 << (m - 2))
-                u = ((u << 1) | 1) & mask
+    def get_total_count(self):
+        return self.count
 
-                scale3 = scale3 + 1
+    def find(self, C):
+        return (self.symbol, 0, self.count)
 
-            e3 = get_bit(l, m - 2) and not get_bit(u, m - 2)
+    def halve(self):
+        self.count = (self.count + 1) >> 1
+        return self
 
-        self.l = l
-        self.u = u
-        self.scale3 = scale3
+    def items(self):
+        return [(self.symbol, self.count)] if self.count else []
 
-    def flush(self):
-        l = self.l
-        u = self.u
-        scale3 = self.scale3
-        m = self.m
-        mask = self.mask
+    def memory_usage(self):
+        return sys.getsizeof(self)
 
-        self.result.append(msb(l, m))
-        l = (l << 1) & mask
-        tag_bits = 1
+# a few symbols: sorted symbols and their counts in two array('I'), cumulative counts are summed on demand
+class SparseCounts:
+    __slots__ = ('symbols', 'counts', 'total')
 
-        while scale3 > 0:
-            self.result.append(1)
-            scale3 = scale3 - 1
+    def __init__(self, symbols, counts):
+        self.symbols = array('I', symbols)
+        self.counts = array('I', counts)
+        self.total = sum(counts)
 
-        while tag_bits < m:
-            self.result.append(msb(l, m))
-            l = (l << 1) & mask
-            tag_bits = tag_bits + 1
+    def contains(self, x):
+        return x in self
 
-        return self.result
+    def __contains__(self, x):
+        i = bisect.bisect_left(self.symbols, x)
+        return i < len(self.symbols) and self.symbols[i] == x
 
-def encode(sequence, max_context_len, alphabet):
-    contexts = dict()
+    def increment_count(self, x):
+        i = bisect.bisect_left(self.symbols, x)
+        if i < len(self.symbols) and self.symbols[i] == x:
+            self.counts[i] += 1
+        else:
+            self.symbols.insert(i, x)
+            self.counts.insert(i, 1)
+        self.total += 1
+        return self
 
-    m = 30
-    entropy_coder = ArithmeticEncoder(m)
+    def get_count(self, x):
+        return self.counts[bisect.bisect_left(self.symbols, x)]
 
-    symbol_index = dict()
-    cum_count = CountArraySparse(len(alphabet))
-    for s in alphabet:
-        index = len(symbol_index)
-        symbol_index[s] = index
-        cum_count.increment_count(index)
+    def get_cum_count(self, x):
+        return sum(self.counts[:bisect.bisect_left(self.symbols, x) + 1])
 
-    contexts[None] = cum_count # -1 order
-    contexts[''] = CountArraySparse(len(alphabet)) # 0 order
+    def get_total_count(self):
+        return self.total
 
-    i = 0
-    while i < len(sequence):
-        k = max(0, i - max_context_len)
-        idx = symbol_index[sequence[i]]
+    def find(self, C):
+        cum_counts = list(itertools.accumulate(self.counts))
+        i = bisect.bisect_right(cum_counts, C)
+        return (self.symbols[i], cum_counts[i] - self.counts[i], cum_counts[i])
 
-        j = k
-        encoded = False
-        while j <= i:
-            ctx_key = sequence[j:i]
-            if ctx_key in contexts:
-                # found context of some order
-                ctx = contexts[ctx_key]
-                if not encoded:
-                    if idx in ctx:
-                        # that context 'knows' the symbol
-                        f_x_1 = ctx.get_cum_count(idx)
-                        f_x = f_x_1 - ctx.get_count(idx)
-                        entropy_coder.encode(f_x, f_x_1, ctx.get_total_count() + 1)
-                        #print("encoded '{}' in context '{}'".format(sequence[i], ctx_key))
-                        encoded = True
-                        # todo: do we break here?
-                    elif ctx.get_total_count() > 0:
-                        # encode escape code
-                        f_x = ctx.get_total_count()
-                        f_x_1 = f_x + 1
-                        #print("encoded %E in context '{}'".format(ctx_key))
-                        entropy_coder.encode(f_x, f_x_1, f_x_1)
-
-                ctx.increment_count(idx)
-            else:
-                assert encoded == False
-                # context not found, create it and update counts
-                contexts[ctx_key] = CountArraySparse(len(alphabet))
-                contexts[ctx_key].increment_count(idx)
+    def halve(self):
+        self.counts = array('I', [(c + 1) >> 1 for c in self.counts])
+        self.total = sum(self.counts)
+        return self
 
-            j = j + 1
+    def items(self):
+        return list(zip(self.symbols, self.counts))
 
-        if not encoded:
-            # encode with -1 order
-            ctx = contexts[None]
-            f_x_1 = ctx.get_cum_count(idx)
-            f_x = f_x_1 - ctx.get_count(idx)
-            entropy_coder.encode(f_x, f_x_1, ctx.get_total_count())
-            #print("encoded '{}' in context 'NONE'".format(sequence[i]))
+    def memory_usage(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.symbols) + sys.getsizeof(self.counts)
 
-        i = i + 1
+# low order contexts see most of the alphabet: counts indexed by symbol plus a fenwick tree for cumulative counts
+class DenseCounts:
+    __slots__ = ('counts', 'tree', 'total')
 
-    return entropy_coder.flush()
+    def __init__(self, size):
+        self.counts = array('I', [0]) * size
+        self.tree = FenwickTree(self.counts)
+        self.total = 0
 
-import functools
+    def contains(self, x):
+        return x in self
 
-class ArithmeticDecoder:
-    def __init__(self, m):
-        self.m = m
-        self.l = 0
-        self.u = (1 << m) - 1
-        self.scale3 = 0
-        self.mask = (1 << m) - 1
-
-    def start(self, sequence):
-        self.t = functools.reduce(lambda x, y: (x << 1) | y, sequence[:self.m], 0)
-        self.sequence_index = self.m
-
-    def decode_symbol(self, ctx, has_escape):
-        t = self.t
-        l = self.l
-        u = self.u
-
-        range_max = ctx.get_total_count()
-        if has_escape:
-            range_max += 1
-        symbol = 0
-        C = math.floor(((t - l + 1) * range_max - 1) / (u - l + 1))
-        while symbol < len(ctx.cum_counts) and (symbol not in ctx or C >= ctx.get_cum_count(symbol)): #todo: don't walk empty spaces
-            symbol = symbol + 1
-
-        range_l = 0
-        range_u = 0
-
-        if symbol < len(ctx.cum_counts):
-            range_u = ctx.get_cum_count(symbol)
-            range_l = ctx.get_cum_count(symbol) - ctx.get_count(symbol)
-        else:
-            assert has_escape
-            range_l = ctx.get_total_count()
-            range_u = range_l + 1
+    def __contains__(self, x):
+        return self.counts[x] > 0
 
-        l1 = l + math.floor((u - l + 1) * range_l / range_max)
-        u1 = l + math.floor((u - l + 1) * range_u / range_max) - 1
+    def increment_count(self, x):
+        self.counts[x] += 1
+        self.tree.add(x, 1)
+        self.total += 1
+        return self
 
-        self.l = l1
-        self.u = u1
+    def get_count(self, x):
+        return self.counts[x]
 
-        return symbol
+    def get_cum_count(self, x):
+        return self.tree.prefix(x + 1)
 
-    def decode_stream(self, prev_symbol, sequence, ctx):
-        m = self.m
-        mask = self.mask
+    def get_total_count(self):
+        return self.total
+
+    def find(self, C):
+        (symbol, range_l) = self.tree.find(C)
+        return (symbol, range_l, range_l + self.counts[symbol])
+
+    def halve(self):
+        self.counts = array('I', [(c + 1) >> 1 for c in self.counts])
+        self.tree = FenwickTree(self.counts)
+        self.total = sum(self.counts)
+        return self
+
+    def items(self):
+        return [(symbol, count) for (symbol, count) in enumerate(self.counts) if count > 0]
+
+    def memory_usage(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.counts) + sys.getsizeof(self.tree) + sys.getsizeof(self.tree.tree)
+
+# context tree: a node is a context, its child for symbol s is the context extended by s and its
+# suffix (vine) pointer is the context without its oldest symbol, down to the order 0 root.
+# current is the longest context before the next symbol, so escaping to a lower order and moving
+# to the next position are single pointer hops, no context strings are ever built
+class ContextNode:
+    __slots__ = ('counts', 'children', 'suffix', 'order')
+
+    def __init__(self, counts, order):
+        self.counts = counts
+        self.children = None
+        self.suffix = None
+        self.order = order
+
+# contexts up to dense_orders use DenseCounts, higher ones start as SingletonCounts.
+# max_contexts bounds the number of contexts (nodes, so encoder and decoder agree whatever the
+# interpreter's object sizes), when it is exceeded the policy kicks in after the update:
+#   restart - drop the whole model and start from an empty root
+#   prune   - drop the least used contexts until half the budget is left, see prune
+PPM_POLICIES = ('restart', 'prune')
+
+class ContextTree:
+    def __init__(self, alphabet_size, max_context_len, dense_orders = 1, max_contexts = None, policy = 'restart'):
+        if policy not in PPM_POLICIES:
+            raise ValueError('unknown policy {}'.format(policy))
+        if max_contexts is not None and max_contexts <= max_context_len + 1:
+            raise ValueError('max_contexts has to be above max_context_len + 1')
+
+        self.alphabet_size = alphabet_size
+        self.max_context_len = max_context_len
+        self.dense_orders = dense_orders
+        self.max_contexts = max_contexts
+        self.policy = policy
+        self.history = deque(maxlen = max_context_len)
+        self.size = 0
+        self.restarts = 0
+        self.prunes = 0
+        self.pruned = 0
+        self.root = self.new_root()
+        self.current = self.root
+
+    def new_root(self):
+        return self.new_node(0)
+
+    def new_node(self, order):
+        self.size += 1
+        if order <= self.dense_orders:
+            return ContextNode(DenseCounts(self.alphabet_size), order)
+        return ContextNode(SingletonCounts(), order)
+
+    def child(self, node, symbol):
+        if node.children is None:
+            return None
+        return node.children.get(symbol)
+
+    # walks current and its suffixes from the highest order down
+    def contexts(self):
+        node = self.current
+        while node is not None:
+            yield node.counts
+            node = node.suffix
+
+    # counts symbol in every context on the vine and moves to the next position. The children for symbol
+    # form the next vine, a node created here starts empty and gets linked to the next lower child.
+    # A context whose total reaches RANGE_BOTTOM is halved, so total + 1 (escape included) always fits the coder
+    def update(self, symbol):
+        node = self.current
+        next_current = None
+        pending = None
+        while node is not None:
+            counts = node.counts.increment_count(symbol)
+            if counts.get_total_count() >= RANGE_BOTTOM:
+                counts = counts.halve()
+            node.counts = counts
+            if node.order < self.max_context_len:
+                child = self.child(node, symbol)
+                if child is None:
+                    child = self.new_node(node.order + 1)
+                    if node.children is None:
+                        node.children = dict()
+                    node.children[symbol] = child
+                if pending is not None:
+                    pending.suffix = child
+                pending = child if child.suffix is None else None
+                if next_current is None:
+                    next_current = child
+            node = node.suffix
+        if pending is not None:
+            pending.suffix = self.root
+        self.current = next_current or self.root
+        self.history.append(symbol)
+
+        if self.max_contexts is not None and self.size > self.max_contexts:
+            if self.policy == 'restart':
+                self.restart()
+            else:
+                self.prune()
+
+    def restart(self):
+        self.size = 0
+        self.root = self.new_root()
+        self.current = self.root
+        self.history.clear()
+        self.restarts += 1
+
+    # removes every context of order >= 1 whose total is at most threshold, with its subtree. A context
+    # is never counted more often than its suffix or its parent, so no surviving suffix pointer dangles.
+    # The threshold doubles until the model is down to half the budget, then current moves to the
+    # longest context of the recent history that is still there
+    def prune(self):
+        threshold = 1
+        while self.size > self.max_contexts // 2:
+            todo = [self.root]
+            while todo:
+                node = todo.pop()
+                if node.children is None:
+                    continue
+                for (symbol, child) in list(node.children.items()):
+                    if child.counts.get_total_count() <= threshold:
+                        del node.children[symbol]
+                        removed = self.subtree_size(child)
+                        self.size -= removed
+                        self.pruned += removed
+                    else:
+                        todo.append(child)
+            threshold *= 2
+
+        self.current = self.find_context(list(self.history))
+        self.prunes += 1
+
+    def subtree_size(self, node):
+        size = 0
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            size += 1
+            if node.children is not None:
+                todo.extend(node.children.values())
+        return size
+
+    def find_context(self, history):
+        for j in range(len(history) + 1):
+            node = self.root
+            for s in history[j:]:
+                node = node.children.get(s) if node.children is not None else None
+                if node is None:
+                    break
+            if node is not None:
+                return node
+        return self.root
+
+    # bytes held by nodes, child dicts and counts, per order
+    def memory_usage(self):
+        usage = [0] * (self.max_context_len + 1)
+        todo = [self.root]
+        while todo:
+            node = todo.pop()
+            usage[node.order] += sys.getsizeof(node) + node.counts.memory_usage()
+            if node.children is not None:
+                usage[node.order] += sys.getsizeof(node.children)
+                todo.extend(node.children.values())
+        return usage
+
+# pre-trained models: train_model feeds sample records into a ContextTree, each from an empty history,
+# write_model flattens it into native uint32 sections
+#   header   magic, version, alphabet_size, max_context_len, n_nodes, n_entries, n_children, alphabet bytes
+#   alphabet utf-8 (alphabet bytes long), zero padded to 4 bytes
+#   nodes    (order, suffix, total, entry_start, entry_end, child_start, child_end) per node, root first
+#   entries  symbols, then inclusive cumulative counts, sorted by symbol within a node
+#   children symbols, then node indices, sorted by symbol within a node
+# so a model can be used straight from an mmap without being parsed into objects
+MODEL_MAGIC = 0x4d4d5050
+MODEL_VERSION = 2
+MODEL_HEADER = 8
+NODE_FIELDS = 7
+
+def train_model(samples, max_context_len, alphabet, max_contexts = None, policy = 'prune'):
+    symbol_index = {s: i for (i, s) in enumerate(alphabet)}
+    tree = ContextTree(len(alphabet), max_context_len, max_contexts = max_contexts, policy = policy)
+    for sample in samples:
+        tree.current = tree.root
+        tree.history.clear()
+        for s in sample:
+            tree.update(symbol_index[s])
+    return tree
+
+def write_model(tree, alphabet):
+    nodes = [tree.root]
+    index = {id(tree.root): 0}
+    i = 0
+    while i < len(nodes):
+        children = nodes[i].children or {}
+        for symbol in sorted(children):
+            index[id(children[symbol])] = len(nodes)
+            nodes.append(children[symbol])
+        i += 1
+
+    records = array('I')
+    entry_symbols = array('I')
+    entry_cum_counts = array('I')
+    child_symbols = array('I')
+    child_nodes = array('I')
+    for node in nodes:
+        entry_start = len(entry_symbols)
+        total = 0
+        for (symbol, count) in node.counts.items():
+            total += count
+            entry_symbols.append(symbol)
+            entry_cum_counts.append(total)
+
+        child_start = len(child_symbols)
+        children = node.children or {}
+        for symbol in sorted(children):
+            child_symbols.append(symbol)
+            child_nodes.append(index[id(children[symbol])])
+
+        suffix = index[id(node.suffix)] if node.suffix is not None else 0
+        records.extend([node.order, suffix, total, entry_start, len(entry_symbols), child_start, len(child_symbols)])
+
+    name = alphabet.encode('utf-8')
+    header = array('I', [MODEL_MAGIC, MODEL_VERSION, len(alphabet), tree.max_context_len, len(nodes), len(entry_symbols), len(child_symbols), len(name)])
+
+    result = bytearray(header.tobytes())
+    result += name + bytes(-len(name) % 4)
+    for section in [records, entry_symbols, entry_cum_counts, child_symbols, child_nodes]:
+        result += section.tobytes()
+    return result
+
+# read only view of a written model over any buffer (bytes, mmap), nothing is copied
+class PpmModel:
+    def __init__(self, data):
+        self.views = []
+        header = self.view(data, 0, MODEL_HEADER)
+        if header[0] != MODEL_MAGIC or header[1] != MODEL_VERSION:
+            raise ValueError('not a ppm model (or written with a different byte order)')
+
+        (self.alphabet_size, self.max_context_len, n_nodes, n_entries, n_children, name_len) = header[2:]
+        offset = 4 * MODEL_HEADER
+        self.alphabet = bytes(data[offset:offset + name_len]).decode('utf-8')
+        offset += name_len + (-name_len % 4)
+
+        sections = []
+        for n in [n_nodes * NODE_FIELDS, n_entries, n_entries, n_children, n_children]:
+            sections.append(self.view(data, offset, n))
+            offset += 4 * n
+        (self.nodes, self.entry_symbols, self.entry_cum_counts, self.child_symbols, self.child_nodes) = sections
+
+    def view(self, data, offset, n):
+        view = memoryview(data)[offset:offset + 4 * n].cast('I')
+        self.views.append(view)
+        return view
+
+    def order(self, index):
+        return self.nodes[index * NODE_FIELDS]
+
+    def suffix(self, index):
+        return self.nodes[index * NODE_FIELDS + 1]
+
+    def child(self, index, symbol):
+        start = self.nodes[index * NODE_FIELDS + 5]
+        end = self.nodes[index * NODE_FIELDS + 6]
+        i = bisect.bisect_left(self.child_symbols, symbol, start, end)
+        if i < end and self.child_symbols[i] == symbol:
+            return self.child_nodes[i]
+        return -1
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+
+# maps a model file, pages are shared through the page cache by every process that loads it
+def load_model(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    model = PpmModel(data)
+    model.mmap = data
+    return model
+
+def close_model(model):
+    model.close()
+    if hasattr(model, 'mmap'):
+        model.mmap.close()
+
+# counts of one model node, the first increment copies them into a SparseCounts (copy on write)
+class FlatCounts:
+    __slots__ = ('model', 'start', 'end', 'total')
+
+    def __init__(self, model, index):
+        record = index * NODE_FIELDS
+        self.model = model
+        self.total = model.nodes[record + 2]
+        self.start = model.nodes[record + 3]
+        self.end = model.nodes[record + 4]
 
-        t = self.t
-        l = self.l
-        u = self.u
-        sequence_index = self.sequence_index
+    def contains(self, x):
+        return x in self
 
-        e3 = get_bit(l, m - 2) and not get_bit(u, m - 2)
+    def index(self, x):
+        return bisect.bisect_left(self.model.entry_symbols, x, self.start, self.end)
 
-        while (msb(l, m) == msb(u, m)) or e3:
-            if msb(l, m) == msb(u, m):
-                l = (l << 1) & mask
-                u = ((u << 1) | 1) & mask
+    def __contains__(self, x):
+        i = self.index(x)
+        return i < self.end and self.model.entry_symbols[i] == x
 
-                t = (t << 1) & mask
-                t |= sequence[sequence_index]
-                sequence_index = sequence_index + 1
+    # (symbols, counts) as lists
+    def unpack(self):
+        symbols = self.model.entry_symbols[self.start:self.end].tolist()
+        cum_counts = self.model.entry_cum_counts[self.start:self.end].tolist()
+        return (symbols, [c - p for (c, p) in zip(cum_counts, [0] + cum_counts[:-1])])
 
-                if sequence_index == len(sequence):
-                    break
+    def increment_count(self, x):
+        (symbols, counts) = self.unpack()
+        return SparseCounts(symbols, counts).increment_count(x)
 
-            if e3:
-                l = l + (1 << (m - 2))
-                l = (l << 1) & mask
-                u = u + (1 << (m - 2))
-                u = ((u << 1) | 1) & mask
-                t = t + (1 << (m - 2))
-                t = (t << 1) & mask
-                t |= sequence[sequence_index]
-                sequence_index = sequence_index + 1
-
-                if sequence_index == len(sequence):
-                    break
+    def get_count(self, x):
+        i = self.index(x)
+        cum_counts = self.model.entry_cum_counts
+        return cum_counts[i] - (cum_counts[i - 1] if i > self.start else 0)
 
-            e3 = get_bit(l, m - 2) and not get_bit(u, m - 2)
+    def get_cum_count(self, x):
+        return self.model.entry_cum_counts[self.index(x)]
 
-        self.t = t
-        self.l = l
-        self.u = u
-        self.sequence_index = sequence_index
+    def get_total_count(self):
+        return self.total
+
+    def find(self, C):
+        cum_counts = self.model.entry_cum_counts
+        i = bisect.bisect_right(cum_counts, C, self.start, self.end)
+        return (self.model.entry_symbols[i], cum_counts[i - 1] if i > self.start else 0, cum_counts[i])
+
+    def halve(self):
+        (symbols, counts) = self.unpack()
+        return SparseCounts(symbols, counts).halve()
+
+    def items(self):
+        return list(zip(*self.unpack()))
+
+    def memory_usage(self):
+        return sys.getsizeof(self)
+
+class OverlayNode(ContextNode):
+    __slots__ = ('base',)
+
+    def __init__(self, counts, order, base):
+        ContextNode.__init__(self, counts, order)
+        self.base = base
+
+# per message view of a model: model nodes are wrapped when first reached and take their updates in
+# private counts, contexts the model does not have are added as ordinary nodes. The model is never
+# written, a new overlay per message starts from the trained state. The root is the wrapped model root,
+# size only counts the contexts added on top of the model
+class OverlayTree(ContextTree):
+    def __init__(self, model, dense_orders = 1):
+        self.model = model
+        super().__init__(model.alphabet_size, model.max_context_len, dense_orders)
+
+    def new_root(self):
+        self.wrapped = dict()
+        return self.wrap(0)
+
+    def wrap(self, index):
+        node = self.wrapped.get(index)
+        if node is None:
+            node = OverlayNode(FlatCounts(self.model, index), self.model.order(index), index)
+            if index != 0:
+                node.suffix = self.wrap(self.model.suffix(index))
+            self.wrapped[index] = node
+        return node
+
+    def child(self, node, symbol):
+        child = ContextTree.child(self, node, symbol)
+        if child is None and isinstance(node, OverlayNode):
+            index = self.model.child(node.base, symbol)
+            if index >= 0:
+                child = self.wrap(index)
+                if node.children is None:
+                    node.children = dict()
+                node.children[symbol] = child
+        return child
+
+# a tree (e.g. a ContextTree with a memory budget) can be passed in, it has to be a fresh one
+# built with the same parameters on both sides
+def encode(sequence, max_context_len, alphabet, tree = None):
+    entropy_coder = RangeEncoder()
 
+    symbol_index = dict()
+    order_minus_one = CountArraySparse(len(alphabet))
+    for s in alphabet:
+        index = len(symbol_index)
+        symbol_index[s] = index
+        order_minus_one.increment_count(index)
 
-def decode(sequence, max_context_len, alphabet, message_len):
-    contexts = dict()
+    if tree is None:
+        tree = ContextTree(len(alphabet), max_context_len)
 
-    m = 30
-    entropy_coder = ArithmeticEncoder(m)
+    for symbol in sequence:
+        idx = symbol_index[symbol]
+
+        encoded = False
+        for ctx in tree.contexts():
+            if idx in ctx:
+                # that context 'knows' the symbol
+                f_x_1 = ctx.get_cum_count(idx)
+                f_x = f_x_1 - ctx.get_count(idx)
+                entropy_coder.encode(f_x, f_x_1, ctx.get_total_count() + 1)
+                encoded = True
+                break
+            elif ctx.get_total_count() > 0:
+                # encode escape code
+                f_x = ctx.get_total_count()
+                f_x_1 = f_x + 1
+                entropy_coder.encode(f_x, f_x_1, f_x_1)
 
+        if not encoded:
+            # encode with -1 order
+            ctx = order_minus_one
+            f_x_1 = ctx.get_cum_count(idx)
+            f_x = f_x_1 - ctx.get_count(idx)
+            entropy_coder.encode(f_x, f_x_1, ctx.get_total_count())
+
+        tree.update(idx)
+
+    return entropy_coder.flush()
+
+# finds the symbol covering the decoder's current cumulative count and consumes it,
+# returns alphabet_size for the escape. Only symbols present in ctx are searched
+def decode_symbol(entropy_decoder, ctx, has_escape, alphabet_size):
+    total = ctx.get_total_count()
+    range_max = total + 1 if has_escape else total
+    C = entropy_decoder.get_freq(range_max)
+
+    if C < total:
+        (symbol, range_l, range_u) = ctx.find(C)
+    else:
+        assert has_escape
+        symbol = alphabet_size
+        range_l = total
+        range_u = total + 1
+
+    entropy_decoder.decode(range_l, range_u, range_max)
+    return symbol
+
+def decode(sequence, max_context_len, alphabet, message_len, tree = None):
     symbol_index = dict()
-    cum_count = CountArraySparse(len(alphabet))
+    order_minus_one = CountArraySparse(len(alphabet))
     for s in alphabet:
         index = len(symbol_index)
         symbol_index[s] = index
-        cum_count.increment_count(index)
+        order_minus_one.increment_count(index)
     inv_symbol_index = {v: k for k, v in symbol_index.items()}
 
-    contexts[None] = cum_count  # -1 order
-    contexts[''] = CountArraySparse(len(alphabet))  # 0 order
+    if tree is None:
+        tree = ContextTree(len(alphabet), max_context_len)
+    entropy_decoder = RangeDecoder(sequence)
 
-    entropy_decoder = ArithmeticDecoder(m)
-    entropy_decoder.start(sequence)
+    msg = []
+    while len(msg) < message_len:
+        symbol = len(alphabet)
+        for ctx in tree.contexts():
+            if ctx.get_total_count() > 0:
+                symbol = decode_symbol(entropy_decoder, ctx, True, len(alphabet))
+                if symbol < len(alphabet): # not escape
+                    break
 
-    symbol = entropy_decoder.decode_symbol(contexts[None], False)
-    contexts[''].increment_count(symbol)
-    msg = inv_symbol_index[symbol]
-    #print("context '{}' adds idx {}".format('', symbol))
-    #print("context '{}' adds symbol '{}'".format('', msg[-1]))
+        if symbol == len(alphabet): # fallback to order -1
+            symbol = decode_symbol(entropy_decoder, order_minus_one, False, len(alphabet))
+            assert symbol < len(alphabet) # no escape for order -1
 
-    i = 1
-    while len(msg) < message_len:
-        k = max(0, i - max_context_len)
-
-        #
-        j = k
-        while j <= i:
-            ctx_key = msg[j:i]
-            if ctx_key in contexts:
-                ctx = contexts[ctx_key]
-                # decode symbol for the context!
-
-                if ctx.get_total_count() > 0:
-                    entropy_decoder.decode_stream(symbol, sequence, ctx)
-                    popped_symbol = entropy_decoder.decode_symbol(ctx, True)
-
-                    if popped_symbol < len(alphabet): # not escape
-                        symbol = popped_symbol
-                        msg += inv_symbol_index[symbol]
-                        #print("decoded '{}' in context '{}'".format(msg[-1], ctx_key))
-                        break
-                    else:
-                        #print("decoded %E in context '{}'".format(ctx_key))
-                        pass
+        msg.append(inv_symbol_index[symbol])
+        tree.update(symbol)
 
-            j = j + 1
+    return ''.join(msg)
 
-        if j == i + 1: # fallback to order -1
-            ctx = contexts[None]
-            entropy_decoder.decode_stream(symbol, sequence, ctx)
-            symbol = entropy_decoder.decode_symbol(ctx, False)
-            assert symbol < len(alphabet) # no escape for order -1
-            msg += inv_symbol_index[symbol]
-            #print("decoded '{}' in context 'NONE'".format(msg[-1]))
+def encode_with_model(model, sequence):
+    return encode(sequence, model.max_context_len, model.alphabet, OverlayTree(model))
 
-        j = k
-        while j <= i:
-            ctx_key = msg[j:i]
-            if ctx_key not in contexts:
-                contexts[ctx_key] = CountArraySparse(len(alphabet))
-            ctx = contexts[ctx_key]
+def decode_with_model(model, sequence, message_len):
+    return decode(sequence, model.max_context_len, model.alphabet, message_len, OverlayTree(model))
 
-            #print("context '{}' adds idx {}".format(ctx_key, symbol))
-            #print("context '{}' adds symbol '{}'".format(ctx_key, msg[-1]))
-            ctx.increment_count(symbol)
+# block mode: blocks are modelled independently so they can be coded in separate processes. Each block's
+# model can first be primed with a short shared prefix (updated, not coded) so it does not start cold.
+# The coded blocks are framed with utils.pack_frame
+def prime_tree(tree, prefix, alphabet):
+    symbol_index = {s: i for (i, s) in enumerate(alphabet)}
+    for s in prefix:
+        tree.update(symbol_index[s])
+    return tree
 
-            j = j + 1
+def encode_block(max_context_len, alphabet, prefix, block):
+    tree = prime_tree(ContextTree(len(alphabet), max_context_len), prefix, alphabet)
+    return (len(block), bytes(encode(block, max_context_len, alphabet, tree)))
 
-        i = i + 1
+def decode_block(max_context_len, alphabet, prefix, block):
+    (n_symbols, data) = block
+    tree = prime_tree(ContextTree(len(alphabet), max_context_len), prefix, alphabet)
+    return decode(data, max_context_len, alphabet, n_symbols, tree)
 
-    return msg
+def encode_blocks(sequence, max_context_len, alphabet, block_size = 1 << 16, prefix = '', max_workers = None):
+    blocks = [sequence[i:i + block_size] for i in range(0, len(sequence), block_size)]
+    return pack_frame(map_chunks(functools.partial(encode_block, max_context_len, alphabet, prefix), blocks, max_workers))
 
-sequence = 'this is the tithe'
+def decode_blocks(data, max_context_len, alphabet, prefix = '', max_workers = None):
+    blocks = unpack_frame(data)
+    return ''.join(map_chunks(functools.partial(decode_block, max_context_len, alphabet, prefix), blocks, max_workers))
 
-e = encode(sequence, 2, 'abcdefghijklmnopqrstuvwxyz ')
-print(e)
-print(decode(e, 2, 'abcdefghijklmnopqrstuvwxyz ', len(sequence)))
+if __name__ == '__main__':
+    sequence = 'this is the tithe'
 
-def decode(sequence, max_context_len, alphabet):
-    pass
+    e = encode(sequence, 2, 'abcdefghijklmnopqrstuvwxyz ')
+    print(list(e))
+    print(decode(e, 2, 'abcdefghijklmnopqrstuvwxyz ', len(sequence)))
 
 import unittest
+import os
+import struct
+import random
+import tempfile
 
 class PpmTestCase(unittest.TestCase):
+    # the text fixture most tests share
+    alphabet = 'abcdefghijklmnopqrstuvwxyz ,.'
+    words = ['the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', 'then', 'sleeps', 'and', 'a']
+
+    def _words(self, n):
+        return ' '.join(random.choice(self.words) for _ in range(n))
+
     def test_count_array_sparse(self):
         ca = CountArraySparse(3)
         ca.increment_count(0)
@@ -487,5 +873,268 @@ class PpmTestCase(unittest.TestCase):
 
     def test_book(self):
         sequence = 'this is the tithe'
-
-        #encode(sequence, 2, 'abcedefghijklmnopqrstuvwxyz ')
+        alphabet = 'abcdefghijklmnopqrstuvwxyz '
+
+        e = encode(sequence, 2, alphabet)
+        self.assertEqual(type(e), bytearray)
+        self.assertEqual(decode(e, 2, alphabet, len(sequence)), sequence)
+
+    def test_encode_decode(self):
+        alphabet = self.alphabet
+        sequence = 'the quick brown fox jumps over the lazy dog, then the dog sleeps. ' * 20
+
+        for max_context_len in range(0, 5):
+            e = encode(sequence, max_context_len, alphabet)
+            self.assertEqual(decode(e, max_context_len, alphabet, len(sequence)), sequence)
+
+        # higher orders should pick up the repetition
+        self.assertLess(len(encode(sequence, 3, alphabet)), len(encode(sequence, 0, alphabet)))
+
+    def _collect_nodes(self, tree):
+        nodes = dict()
+        todo = [((), tree.root)]
+        while todo:
+            (key, node) = todo.pop()
+            nodes[key] = node
+            self.assertEqual(node.order, len(key))
+            for (s, child) in (node.children or {}).items():
+                todo.append((key + (s,), child))
+        return nodes
+
+    def test_context_tree(self):
+        sequence = [0, 1, 0, 2, 0, 1, 0, 1, 1, 2, 0]
+        tree = ContextTree(3, 3)
+        for s in sequence:
+            tree.update(s)
+
+        nodes = self._collect_nodes(tree)
+
+        # every substring of length <= 3 that was followed by a position is a context
+        expected = set(tuple(sequence[j:i]) for i in range(len(sequence) + 1) for j in range(max(0, i - 3), i + 1))
+        self.assertEqual(set(nodes), expected)
+
+        for (key, node) in nodes.items():
+            if key:
+                self.assertIs(node.suffix, nodes[key[1:]])
+        self.assertIsNone(tree.root.suffix)
+        self.assertIs(tree.current, nodes[tuple(sequence[-3:])])
+
+        # counts are the symbols that followed each context
+        for (key, node) in nodes.items():
+            for s in range(3):
+                followers = sum(1 for i in range(len(sequence)) if tuple(sequence[max(0, i - len(key)):i]) == key and i >= len(key) and sequence[i] == s)
+                self.assertEqual(node.counts.get_count(s) if s in node.counts else 0, followers)
+
+    def test_count_layouts(self):
+        random.seed(0)
+
+        for symbols in [[3], [3, 3, 1], [5, 0, 9, 9, 2, 5, 5, 7, 0], [random.randrange(40) for _ in range(300)]]:
+            reference = CountArraySparse(40)
+            layouts = [SingletonCounts(), DenseCounts(40)]
+            for x in symbols:
+                reference.increment_count(x)
+                layouts = [ca.increment_count(x) for ca in layouts]
+
+            for ca in layouts:
+                self.assertEqual(ca.get_total_count(), reference.get_total_count())
+                for x in range(40):
+                    self.assertEqual(x in ca, x in reference)
+                    if x in reference:
+                        self.assertEqual(ca.get_count(x), reference.get_count(x))
+                        self.assertEqual(ca.get_cum_count(x), reference.get_cum_count(x))
+
+        ca = SingletonCounts()
+        self.assertIs(ca.increment_count(4), ca)
+        self.assertIs(ca.increment_count(4), ca)
+        self.assertIsInstance(ca.increment_count(1), SparseCounts)
+
+        # halving rounds up, every present symbol keeps a count
+        symbols = [5, 0, 9, 9, 2, 5, 5, 7, 0, 9, 9, 9]
+        layouts = [CountArraySparse(40), SingletonCounts(), DenseCounts(40)]
+        for x in symbols:
+            layouts = [ca.increment_count(x) for ca in layouts]
+        expected = [(0, 1), (2, 1), (5, 2), (7, 1), (9, 3)]
+        for ca in layouts:
+            ca = ca.halve()
+            self.assertEqual([(x, ca.get_count(x)) for x in range(40) if x in ca], expected)
+            self.assertEqual(ca.get_total_count(), 8)
+            self.assertEqual(ca.get_cum_count(5), 4)
+            self.assertEqual(ca.find(4), (7, 4, 5))
+            ca = ca.increment_count(3)
+            self.assertEqual(ca.get_cum_count(5), 5)
+            self.assertEqual(ca.get_total_count(), 9)
+
+    # a context close to RANGE_BOTTOM is halved on the way, on both sides, instead of stalling the coder
+    def test_large_total(self):
+        alphabet = 'abc'
+        sequence = 'abacabcbbaca' * 20
+
+        def big_tree():
+            tree = ContextTree(len(alphabet), 0)
+            root = tree.root.counts
+            root.counts[0] = RANGE_BOTTOM - 100
+            root.counts[2] = 1
+            root.tree = FenwickTree(root.counts)
+            root.total = RANGE_BOTTOM - 99
+            return tree
+
+        tree = big_tree()
+        enc = encode(sequence, 0, alphabet, tree)
+        self.assertLess(tree.root.counts.get_total_count(), RANGE_BOTTOM // 2 + len(sequence))
+        self.assertEqual(decode(enc, 0, alphabet, len(sequence), big_tree()), sequence)
+
+    def test_memory_usage(self):
+        sequence = ('the quick brown fox jumps over the lazy dog, then the dog sleeps. ' * 20)
+        alphabet = self.alphabet
+        tree = ContextTree(len(alphabet), 4)
+        for s in sequence:
+            tree.update(alphabet.index(s))
+
+        usage = tree.memory_usage()
+        self.assertEqual(len(usage), 5)
+        self.assertTrue(all(u > 0 for u in usage))
+
+        # one alphabet sized CountArraySparse per context would cost at least this much
+        n_contexts = 0
+        todo = [tree.root]
+        while todo:
+            node = todo.pop()
+            n_contexts += 1
+            todo.extend((node.children or {}).values())
+        self.assertLess(sum(usage), n_contexts * 2 * sys.getsizeof([0] * len(alphabet)))
+
+    def test_find(self):
+        random.seed(1)
+
+        for symbols in [[3], [3, 3, 1], [5, 0, 9, 9, 2, 5, 5, 7, 0], [random.randrange(40) for _ in range(300)]]:
+            layouts = [CountArraySparse(40), SingletonCounts(), DenseCounts(40)]
+            for x in symbols:
+                layouts = [ca.increment_count(x) for ca in layouts]
+
+            reference = layouts[0]
+            for C in range(reference.get_total_count()):
+                x = [s for s in range(40) if s in reference and reference.get_cum_count(s) > C][0]
+                expected = (x, reference.get_cum_count(x) - reference.get_count(x), reference.get_cum_count(x))
+                for ca in layouts:
+                    self.assertEqual(ca.find(C), expected)
+
+    def test_bounded(self):
+        random.seed(2)
+        alphabet = self.alphabet
+        sequence = self._words(1500)
+        unbounded = encode(sequence, 4, alphabet)
+
+        sizes = dict()
+        for policy in PPM_POLICIES:
+            tree = ContextTree(len(alphabet), 4, max_contexts = 300, policy = policy)
+            e = encode(sequence, 4, alphabet, tree)
+            self.assertEqual(decode(e, 4, alphabet, len(sequence), ContextTree(len(alphabet), 4, max_contexts = 300, policy = policy)), sequence)
+            self.assertGreater(tree.restarts + tree.prunes, 0)
+            self.assertLessEqual(tree.size, 300)
+
+            nodes = self._collect_nodes(tree)
+            self.assertEqual(len(nodes), tree.size)
+            for (key, node) in nodes.items():
+                if key:
+                    self.assertIs(node.suffix, nodes[key[1:]])
+            self.assertIn(tree.current, nodes.values())
+            sizes[policy] = len(e)
+
+        # pruning keeps the frequent contexts, a restart loses them all
+        self.assertLess(sizes['prune'], sizes['restart'])
+        self.assertLess(sizes['prune'], len(unbounded) * 1.2)
+
+        tree = ContextTree(len(alphabet), 4, max_contexts = 300, policy = 'prune')
+        for s in sequence:
+            tree.update(alphabet.index(s))
+            self.assertLessEqual(tree.size, 300)
+        self.assertEqual(tree.restarts, 0)
+        self.assertGreater(tree.pruned, 0)
+
+        with self.assertRaises(ValueError):
+            ContextTree(len(alphabet), 4, max_contexts = 300, policy = 'freeze')
+
+    def test_model(self):
+        random.seed(3)
+        alphabet = self.alphabet
+        def record():
+            return self._words(random.randint(5, 40)) + '.'
+
+        tree = train_model([record() for _ in range(200)], 3, alphabet)
+        data = write_model(tree, alphabet)
+        model = PpmModel(data)
+        self.assertEqual(model.alphabet, alphabet)
+        self.assertEqual(model.max_context_len, 3)
+
+        # the flat layout answers like the tree it was written from
+        nodes = self._collect_nodes(tree)
+        for (key, node) in nodes.items():
+            index = 0
+            for s in key:
+                index = model.child(index, s)
+            self.assertEqual(model.order(index), len(key))
+            counts = FlatCounts(model, index)
+            self.assertEqual(counts.items(), node.counts.items())
+            self.assertEqual(counts.get_total_count(), node.counts.get_total_count())
+            for C in range(counts.get_total_count()):
+                self.assertEqual(counts.find(C), node.counts.find(C))
+        self.assertEqual(model.child(0, len(alphabet)), -1)
+
+        (fd, path) = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            model = load_model(path)
+
+            for _ in range(20):
+                message = record()
+                e = encode_with_model(model, message)
+                self.assertEqual(decode_with_model(model, e, len(message)), message)
+                # updates stay in the overlay, the same message codes the same way again
+                self.assertEqual(encode_with_model(model, message), e)
+                self.assertLess(len(e), len(encode(message, 3, alphabet)))
+
+            # a message with contexts the model never saw
+            message = 'zzz qqq xxx, the fox'
+            e = encode_with_model(model, message)
+            self.assertEqual(decode_with_model(model, e, len(message)), message)
+
+            close_model(model)
+        finally:
+            os.remove(path)
+
+        with self.assertRaises(ValueError):
+            PpmModel(bytes(64))
+
+        # the alphabet is stored with its exact byte length, a trailing '\0' or multibyte symbols included
+        for alphabet in ['ab\0', '\0', 'abcd', 'x\u00e9\0\0']:
+            message = alphabet * 5 + alphabet[::-1]
+            model = PpmModel(write_model(train_model([message], 2, alphabet), alphabet))
+            self.assertEqual(model.alphabet, alphabet)
+            self.assertEqual(model.nodes[2], len(message))
+            e = encode_with_model(model, message)
+            self.assertEqual(decode_with_model(model, e, len(message)), message)
+
+        overlay = OverlayTree(model)
+        self.assertIsInstance(overlay.root, OverlayNode)
+        self.assertEqual((overlay.size, overlay.wrapped), (0, {0: overlay.root}))
+
+    def test_blocks(self):
+        alphabet = self.alphabet
+        sequence = 'the quick brown fox jumps over the lazy dog, then the dog sleeps. ' * 30
+        prefix = 'the dog sleeps. the fox jumps. '
+
+        self.assertEqual(decode_blocks(encode_blocks('', 2, alphabet, max_workers = 1), 2, alphabet, max_workers = 1), '')
+
+        e = encode_blocks(sequence, 3, alphabet, 500, max_workers = 1)
+        self.assertEqual(struct.unpack_from('>III', e), (4, 500, len(encode(sequence[:500], 3, alphabet))))
+        self.assertEqual(decode_blocks(e, 3, alphabet, max_workers = 1), sequence)
+
+        # blocks do not depend on the worker they ran on
+        self.assertEqual(encode_blocks(sequence, 3, alphabet, 500, max_workers = 2), e)
+        self.assertEqual(decode_blocks(e, 3, alphabet, max_workers = 2), sequence)
+
+        primed = encode_blocks(sequence, 3, alphabet, 500, prefix, max_workers = 1)
+        self.assertEqual(decode_blocks(primed, 3, alphabet, prefix, max_workers = 1), sequence)
+        self.assertLess(len(primed), len(e))
+        self.assertLess(len(encode(sequence, 3, alphabet)), len(e))
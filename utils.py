@@ -1,5 +1,7 @@
+import concurrent.futures
 import functools
 import math
+import struct
 
 def get_average_codelength(code, freq):
     sum = functools.reduce(lambda x, y : x + y, [a[1] for a in freq])
@@ -15,6 +17,88 @@ def build_frequency(sequence):
         counts[i] = counts.get(i, 0) + 1
     return list(counts.items())
 
+# msb-first bit packing, bits are accumulated in a python int and moved in
+# 64-bit words
+class BitWriter:
+    def __init__(self):
+        self.result = bytearray()
+        self.acc = 0
+        self.acc_bits = 0
+        self.bit_count = 0
+
+    def write(self, value, n):
+        self.acc = (self.acc << n) | value
+        self.acc_bits += n
+        self.bit_count += n
+
+        while self.acc_bits >= 64:
+            self.acc_bits -= 64
+            self.result += (self.acc >> self.acc_bits).to_bytes(8, 'big')
+            self.acc &= (1 << self.acc_bits) - 1
+
+    def flush(self):
+        pad = -self.acc_bits % 8
+        self.result += (self.acc << pad).to_bytes((self.acc_bits + pad) // 8, 'big')
+        self.acc = 0
+        self.acc_bits = 0
+        return self.result
+
+# reads past the end of data return zeros
+class BitReader:
+    def __init__(self, data):
+        self.data = memoryview(data).cast('B')
+        self.byte_index = 0
+        self.acc = 0
+        self.acc_bits = 0
+        self.position = 0
+
+    def peek(self, n):
+        while self.acc_bits < n:
+            chunk = self.data[self.byte_index:self.byte_index + 8]
+            self.acc = (self.acc << 64) | (int.from_bytes(chunk, 'big') << (64 - 8 * len(chunk)))
+            self.acc_bits += 64
+            self.byte_index += 8
+        return (self.acc >> (self.acc_bits - n)) & ((1 << n) - 1)
+
+    def skip(self, n):
+        self.peek(n)
+        self.acc_bits -= n
+        self.acc &= (1 << self.acc_bits) - 1
+        self.position += n
+
+    def read(self, n):
+        value = self.peek(n)
+        self.skip(n)
+        return value
+
+# block parallel coding: chunks are coded independently, map_chunks runs f over them serially for
+# max_workers == 1, otherwise in a process pool (f has to be picklable). The frame of the coded
+# (n_symbols, data) chunks is the chunk count, then (symbols, bytes) per chunk as 32-bit big endian,
+# then the payloads
+def map_chunks(f, chunks, max_workers):
+    if max_workers == 1:
+        return list(map(f, chunks))
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        return list(executor.map(f, chunks))
+
+def pack_frame(chunks):
+    result = bytearray(struct.pack('>I', len(chunks)))
+    for (n_symbols, data) in chunks:
+        result += struct.pack('>II', n_symbols, len(data))
+    for (n_symbols, data) in chunks:
+        result += data
+    return result
+
+def unpack_frame(data):
+    (n_chunks,) = struct.unpack_from('>I', data, 0)
+    chunks = []
+    offset = 4 + 8 * n_chunks
+    for i in range(n_chunks):
+        (n_symbols, n_bytes) = struct.unpack_from('>II', data, 4 + 8 * i)
+        chunks.append((n_symbols, bytes(data[offset:offset + n_bytes])))
+        offset += n_bytes
+    return chunks
+
 import unittest
 
 class UtilsTestCase(unittest.TestCase):
@@ -28,4 +112,34 @@ class UtilsTestCase(unittest.TestCase):
     def test_frequency(self):
         self.assertEqual(build_frequency([0, 1]), [(0, 1), (1, 1)])
         self.assertEqual(build_frequency([0, 1, 1, 1, 0]), [(0, 2), (1, 3)])
-        self.assertEqual(build_frequency([0, 1, 2, 2, 2, 2]), [(0, 1), (1, 1), (2, 4)])
\ No newline at end of file
+        self.assertEqual(build_frequency([0, 1, 2, 2, 2, 2]), [(0, 1), (1, 1), (2, 4)])
+
+    def test_bit_packing(self):
+        w = BitWriter()
+        values = [(1, 1), (0, 3), (5, 3), (1234567, 21), (0, 0), ((1 << 70) - 3, 70), (2, 2)]
+        for (v, n) in values:
+            w.write(v, n)
+        data = w.flush()
+
+        total = sum(n for (v, n) in values)
+        self.assertEqual(w.bit_count, total)
+        self.assertEqual(len(data), (total + 7) // 8)
+
+        for d in [data, bytes(data), memoryview(data)]:
+            r = BitReader(d)
+            for (v, n) in values:
+                self.assertEqual(r.read(n), v)
+            self.assertEqual(r.position, total)
+            self.assertEqual(r.read(16), 0)
+
+    def test_frame(self):
+        chunks = [(3, b'abc'), (0, b''), (1000, bytes(range(256)))]
+        data = pack_frame(chunks)
+        self.assertEqual(struct.unpack_from('>IIIII', data), (3, 3, 3, 0, 0))
+        self.assertEqual(len(data), 4 + 8 * 3 + 3 + 256)
+        for d in [data, bytes(data), memoryview(data)]:
+            self.assertEqual(unpack_frame(d), chunks)
+        self.assertEqual(unpack_frame(pack_frame([])), [])
+
+        self.assertEqual(map_chunks(len, ['a', 'bcd', ''], 1), [1, 3, 0])
+        self.assertEqual(map_chunks(len, ['a', 'bcd', ''], 2), [1, 3, 0])